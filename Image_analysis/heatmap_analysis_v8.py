@@ -1,8 +1,17 @@
-import svgwrite
+import os
+import base64
+import hashlib
+import mimetypes
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from xml.sax.saxutils import quoteattr
+import cv2
 import numpy as np
 from PIL import Image
 import math
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 # Define a function to compute the gradient direction in degrees
 def compute_gradient_direction(dx, dy):
@@ -10,100 +19,879 @@ def compute_gradient_direction(dx, dy):
     angle = math.degrees(math.atan2(dy, dx))
     return angle if angle >= 0 else angle + 360
 
+# Define a function to compute the gradient direction for whole arrays at once
+def compute_gradient_directions(dx, dy):
+    """Vectorised compute_gradient_direction: directions in degrees [0, 360) from dx, dy arrays."""
+    angles = np.degrees(np.arctan2(dy, dx))
+    angles[angles < 0] += 360
+    return angles
+
+# Define a function to average np.gradient over every box of a regular block grid
+def _block_mean_gradients(red_channel, box_h, box_w):
+    """
+    Mean per-box gradients of a channel whose shape is a multiple of (box_h, box_w).
+
+    The channel is reshaped to (rows, box_h, cols, box_w) so that np.gradient along
+    axes 1 and 3 sees each box on its own, exactly like calling np.gradient on every
+    box slice. A box that is a single pixel wide (or tall) has no gradient along that
+    axis and gets 0 there.
+    """
+    rows, cols = red_channel.shape[0] // box_h, red_channel.shape[1] // box_w
+    blocks = red_channel.reshape(rows, box_h, cols, box_w).astype(np.float64)
+
+    mean_dx = np.zeros((rows, cols))
+    mean_dy = np.zeros((rows, cols))
+    if box_w > 1:
+        mean_dx = np.gradient(blocks, axis=3).mean(axis=(1, 3))
+    if box_h > 1:
+        mean_dy = np.gradient(blocks, axis=1).mean(axis=(1, 3))
+    return mean_dx, mean_dy
+
+# Define a function to compute the mean gradient and direction of every grid box
+def compute_gradient_field(red_channel, box_size_px):
+    """
+    Compute the mean gradient and gradient direction of every grid box in one go.
+
+    Parameters:
+    - red_channel (ndarray): 2D array of the channel to analyse.
+    - box_size_px (int): Size of each grid box in pixels.
+
+    Returns:
+    - field (ndarray): Array of shape (rows, cols, 3) holding mean_dx, mean_dy and the
+      gradient direction in degrees [0, 360) for the box at (row, col). Boxes on the
+      right and bottom edges are clipped to the image, as in the per-box loop.
+    """
+    if box_size_px < 1:
+        raise ValueError("Grid box size must be at least one pixel.")
+
+    height, width = red_channel.shape
+    rows = -(-height // box_size_px)
+    cols = -(-width // box_size_px)
+    full_h = (height // box_size_px) * box_size_px
+    full_w = (width // box_size_px) * box_size_px
+
+    field = np.zeros((rows, cols, 3))
+
+    # Split the image into the full boxes and the clipped strips along the right and bottom edges
+    row_parts = [(0, full_h, box_size_px)] + ([(full_h, height, height - full_h)] if full_h < height else [])
+    col_parts = [(0, full_w, box_size_px)] + ([(full_w, width, width - full_w)] if full_w < width else [])
+    for y0, y1, box_h in row_parts:
+        for x0, x1, box_w in col_parts:
+            if y1 == y0 or x1 == x0:
+                continue
+            mean_dx, mean_dy = _block_mean_gradients(red_channel[y0:y1, x0:x1], box_h, box_w)
+            r0, c0 = y0 // box_size_px, x0 // box_size_px
+            field[r0:r0 + mean_dx.shape[0], c0:c0 + mean_dx.shape[1], 0] = mean_dx
+            field[r0:r0 + mean_dy.shape[0], c0:c0 + mean_dy.shape[1], 1] = mean_dy
+
+    field[:, :, 2] = compute_gradient_directions(field[:, :, 0], field[:, :, 1])
+    return field
+
+# Define a function to build the summed-area table of the red channel
+def build_gradient_index(image_path, index_path=None):
+    """
+    Build and save a summed-area table (integral image) of the red channel next to the image.
+
+    The mean of np.gradient over a box only depends on the first two and last two
+    columns (for dx) or rows (for dy) of the box, so the box means of any grid size
+    or offset can be read from the integral image of the red channel in O(1) per box.
+
+    Parameters:
+    - image_path (str): Path to the input image.
+    - index_path (str): Where to save the index. Defaults to "<image_path>.sat.npy".
+
+    Returns:
+    - sat (ndarray): Summed-area table of shape (height + 1, width + 1).
+    """
+    if index_path is None:
+        index_path = image_path + ".sat.npy"
+
+    red_channel = np.array(Image.open(image_path).convert("RGB"))[:, :, 0]
+    height, width = red_channel.shape
+
+    # uint32 is enough unless the total brightness of the image can overflow it
+    dtype = np.uint32 if 255 * height * width < 2 ** 32 else np.uint64
+    sat = np.zeros((height + 1, width + 1), dtype=dtype)
+    np.cumsum(red_channel, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, dtype=dtype, out=sat[1:, 1:])
+
+    np.save(index_path, sat)
+    print(f"Saved gradient index to '{index_path}'")
+    return sat
+
+# Define a function to load the summed-area table, rebuilding it when the image changed
+def load_gradient_index(image_path, index_path=None):
+    """Load the gradient index of the image (memory-mapped), building it first if it is missing or stale."""
+    if index_path is None:
+        index_path = image_path + ".sat.npy"
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(image_path):
+        build_gradient_index(image_path, index_path)
+    return np.load(index_path, mmap_mode="r")
+
+# Define a function to read the gradient field of any grid from the summed-area table
+def compute_gradient_field_from_index(sat, box_size_px, offset=(0, 0)):
+    """
+    Compute the same field as compute_gradient_field from a summed-area table.
+
+    Parameters:
+    - sat (ndarray): Summed-area table from build_gradient_index / load_gradient_index.
+    - box_size_px (int): Size of each grid box in pixels.
+    - offset (tuple): (y, x) pixel position of the first grid box.
+
+    Returns:
+    - field (ndarray): Array of shape (rows, cols, 3) holding mean_dx, mean_dy and direction.
+    """
+    if box_size_px < 1:
+        raise ValueError("Grid box size must be at least one pixel.")
+
+    height, width = sat.shape[0] - 1, sat.shape[1] - 1
+    y0 = np.arange(offset[0], height, box_size_px)
+    x0 = np.arange(offset[1], width, box_size_px)
+    y1 = np.minimum(y0 + box_size_px, height)
+    x1 = np.minimum(x0 + box_size_px, width)
+    box_h = (y1 - y0)[:, None]
+    box_w = (x1 - x0)[None, :]
+
+    # Sums of the red channel over the rows of each grid row (per column) and the columns of each grid column (per row)
+    column_strip = np.diff(sat[y1].astype(np.int64) - sat[y0], axis=1)
+    row_strip = np.diff(sat[:, x1].astype(np.int64) - sat[:, x0], axis=0)
+
+    def column_sums(columns):
+        return column_strip[:, np.clip(columns, 0, width - 1)]
+
+    def row_sums(rows):
+        return row_strip[np.clip(rows, 0, height - 1), :]
+
+    # Sum of np.gradient over n samples f0..f(n-1) is 1.5 * (f(n-1) - f0) + 0.5 * (f1 - f(n-2))
+    sum_dx = 1.5 * (column_sums(x1 - 1) - column_sums(x0)) + 0.5 * (column_sums(x0 + 1) - column_sums(x1 - 2))
+    sum_dy = 1.5 * (row_sums(y1 - 1) - row_sums(y0)) + 0.5 * (row_sums(y0 + 1) - row_sums(y1 - 2))
+
+    field = np.zeros((len(y0), len(x0), 3))
+    field[:, :, 0] = np.where(box_w > 1, sum_dx / (box_h * box_w), 0)
+    field[:, :, 1] = np.where(box_h > 1, sum_dy / (box_h * box_w), 0)
+    field[:, :, 2] = compute_gradient_directions(field[:, :, 0], field[:, :, 1])
+    return field
+
+# Define a function to compute the gradient field for several grid sizes of the same image
+def sweep_grid_sizes(image_path, grid_sizes_mm, resolution_dpi=300):
+    """
+    Compute the gradient field of the image for several grid sizes using the gradient index.
+
+    Returns:
+    - fields (dict): Gradient field for each grid size in mm.
+    """
+    mm_to_inch = 25.4
+    sat = load_gradient_index(image_path)
+    return {grid_size_mm: compute_gradient_field_from_index(sat, int((grid_size_mm / mm_to_inch) * resolution_dpi))
+            for grid_size_mm in grid_sizes_mm}
+
+# Bits per pixel of the raw pixel layouts that decode_to_raster can read strip by strip
+_RAW_BITS = {"1": 1, "L": 8, "P": 8, "RGB": 24, "BGR": 24, "RGBX": 32, "BGRX": 32, "RGBA": 32, "BGRA": 32,
+             "CMYK": 32}
+
+# Define a function to narrow the raw tiles of an image to a band of rows
+def _raw_strip_tiles(img, y0, y1):
+    """
+    Return the raw tiles (extents relative to row y0, file offset, (rawmode, stride,
+    orientation)) holding rows [y0, y1) of the image, or None if the image is not stored
+    as uncompressed raw rows (JPEG, PNG, compressed TIFF, ...).
+    """
+    strip_tiles = []
+    for codec_name, (x0, ty0, x1, ty1), offset, args in img.tile:
+        if codec_name != "raw":
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        if stride == 0:
+            if rawmode not in _RAW_BITS:
+                return None
+            stride = (_RAW_BITS[rawmode] * (x1 - x0) + 7) // 8
+        r0, r1 = max(ty0, y0), min(ty1, y1)
+        if r0 >= r1:
+            continue
+        # Bottom-up files (orientation -1, e.g. BMP) store the last row first
+        skip = (r0 - ty0) if orientation >= 0 else (ty1 - r1)
+        strip_tiles.append(("raw", (x0, r0 - y0, x1, r1 - y0), offset + skip * stride,
+                            (rawmode, stride, orientation)))
+    return strip_tiles
+
+# Define a function to decode the red channel once into a memory-mapped raster
+def decode_to_raster(image_path, raster_path=None, strip_rows=1024):
+    """
+    Decode the red channel of the image into a memory-mapped uint8 .npy raster next to the image.
+
+    Uncompressed images (BMP, PPM, uncompressed TIFF) are decoded strip by strip, so
+    memory is bounded by strip_rows. Compressed single-stream formats (JPEG, PNG,
+    compressed TIFF) cannot be decoded in parts by PIL: they are decoded whole once,
+    so the first run on such an image needs memory for the full decoded image. Later
+    runs read tiles straight from the raster on disk either way.
+
+    Parameters:
+    - image_path (str): Path to the input image.
+    - raster_path (str): Where to save the raster. Defaults to "<image_path>.red.npy".
+    - strip_rows (int): Number of rows decoded and copied into the raster at a time.
+
+    Returns:
+    - raster (memmap): Read-only red channel of shape (height, width).
+    """
+    if raster_path is None:
+        raster_path = image_path + ".red.npy"
+    if os.path.exists(raster_path) and os.path.getmtime(raster_path) >= os.path.getmtime(image_path):
+        return np.load(raster_path, mmap_mode="r")
+
+    img = Image.open(image_path)
+    width, height = img.size
+    raster = np.lib.format.open_memmap(raster_path, mode="w+", dtype=np.uint8, shape=(height, width))
+    # A transposing EXIF orientation is applied on load, so such images are decoded whole
+    if _raw_strip_tiles(img, 0, height) is None or img.getexif().get(0x0112, 1) != 1:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        red = img.getchannel(0)
+        del img
+        for y in range(0, height, strip_rows):
+            raster[y:y + strip_rows] = np.asarray(red.crop((0, y, width, min(y + strip_rows, height))))
+        del red
+    else:
+        with open(image_path, "rb") as fp:
+            for y in range(0, height, strip_rows):
+                # Read and unpack only the rows of this strip
+                y1 = min(y + strip_rows, height)
+                parts = []
+                for _, (x0, r0, x1, r1), offset, (rawmode, stride, orientation) in _raw_strip_tiles(img, y, y1):
+                    fp.seek(offset)
+                    parts.append((Image.frombytes(img.mode, (x1 - x0, r1 - r0), fp.read(stride * (r1 - r0)),
+                                                  "raw", rawmode, stride, orientation), (x0, r0)))
+                if len(parts) == 1 and parts[0][0].size == (width, y1 - y):
+                    strip = parts[0][0]
+                else:
+                    strip = Image.new(img.mode, (width, y1 - y))
+                    for part, position in parts:
+                        strip.paste(part, position)
+                if img.palette is not None:
+                    palette_mode, palette = img.palette.getdata()
+                    strip.putpalette(palette, palette_mode)
+                if strip.mode != "RGB":
+                    strip = strip.convert("RGB")
+                raster[y:y1] = np.asarray(strip.getchannel(0))
+    raster.flush()
+    del raster
+    print(f"Saved decoded raster to '{raster_path}'")
+    return np.load(raster_path, mmap_mode="r")
+
+# Define a function to compute the gradient field tile by tile
+def iter_gradient_field_tiles(red_channel, box_size_px, tile_size_px=4096):
+    """
+    Compute the gradient field tile by tile, reading only one tile of the channel at a time.
+
+    Tiles are snapped to whole grid boxes. The box gradients never look outside their
+    own box, so tiles need no overlap and the field matches compute_gradient_field
+    exactly at the seams.
+
+    Parameters:
+    - red_channel (ndarray): 2D array (or memmap) of the channel to analyse.
+    - box_size_px (int): Size of each grid box in pixels.
+    - tile_size_px (int): Approximate tile size in pixels.
+
+    Yields:
+    - (row, col, field_tile): Grid position of the tile's first box and its gradient field.
+    """
+    if box_size_px < 1:
+        raise ValueError("Grid box size must be at least one pixel.")
+    tile_size_px = max(box_size_px, (tile_size_px // box_size_px) * box_size_px)
+
+    height, width = red_channel.shape
+    for y in range(0, height, tile_size_px):
+        for x in range(0, width, tile_size_px):
+            tile = red_channel[y:y + tile_size_px, x:x + tile_size_px]
+            yield y // box_size_px, x // box_size_px, compute_gradient_field(tile, box_size_px)
+
+# Define a worker that fills one band of grid rows of a shared gradient field
+def _fill_gradient_field_band(red_name, red_shape, field_name, field_shape, box_size_px, row_start, row_stop):
+    """Compute grid rows [row_start, row_stop) from the shared red channel into the shared field."""
+    red_shm = shared_memory.SharedMemory(name=red_name)
+    field_shm = shared_memory.SharedMemory(name=field_name)
+    try:
+        red_channel = np.ndarray(red_shape, dtype=np.uint8, buffer=red_shm.buf)
+        field = np.ndarray(field_shape, dtype=np.float64, buffer=field_shm.buf)
+        band = red_channel[row_start * box_size_px:row_stop * box_size_px]
+        field[row_start:row_stop] = compute_gradient_field(band, box_size_px)
+        del red_channel, field, band
+    finally:
+        red_shm.close()
+        field_shm.close()
+
+# Define a function to compute the gradient field on several cores
+def compute_gradient_field_parallel(red_channel, box_size_px, workers=None, bands_per_worker=4):
+    """
+    Compute the same field as compute_gradient_field with a pool of worker processes.
+
+    The red channel is copied into shared memory once and every worker writes its band
+    of grid rows straight into a shared output field, so no pixel data is pickled.
+
+    Parameters:
+    - red_channel (ndarray): 2D array of the channel to analyse.
+    - box_size_px (int): Size of each grid box in pixels.
+    - workers (int): Number of worker processes. Defaults to the number of CPUs.
+    - bands_per_worker (int): Bands of grid rows per worker, for load balancing.
+
+    Returns:
+    - field (ndarray): Array of shape (rows, cols, 3) holding mean_dx, mean_dy and direction.
+    """
+    if box_size_px < 1:
+        raise ValueError("Grid box size must be at least one pixel.")
+    workers = workers or os.cpu_count()
+
+    height, width = red_channel.shape
+    field_shape = (-(-height // box_size_px), -(-width // box_size_px), 3)
+    red_shm = shared_memory.SharedMemory(create=True, size=max(1, red_channel.nbytes))
+    field_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(field_shape)) * 8)
+    try:
+        np.ndarray(red_channel.shape, dtype=np.uint8, buffer=red_shm.buf)[:] = red_channel
+
+        # Split the grid rows into bands, a few per worker so faster workers pick up more
+        band_count = min(field_shape[0], workers * bands_per_worker)
+        edges = np.linspace(0, field_shape[0], band_count + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_fill_gradient_field_band, red_shm.name, red_channel.shape,
+                                       field_shm.name, field_shape, box_size_px, start, stop)
+                       for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+            for future in futures:
+                future.result()
+
+        return np.ndarray(field_shape, dtype=np.float64, buffer=field_shm.buf).copy()
+    finally:
+        red_shm.close()
+        red_shm.unlink()
+        field_shm.close()
+        field_shm.unlink()
+
+# Define a function to turn the gradient field into arrow coordinates
+def compute_arrow_geometry(field, box_size_px, arrow_size, min_arrowhead_size=5, row_offset=0, col_offset=0):
+    """
+    Compute the arrows for every box whose gradient indicates a transition from lighter red to deeper red.
+
+    Parameters:
+    - field (ndarray): Gradient field from compute_gradient_field.
+    - box_size_px (int): Size of each grid box in pixels.
+    - arrow_size (float): Length of the arrows.
+    - min_arrowhead_size (float): Minimum size for the arrowhead.
+    - row_offset, col_offset (int): Grid position of field[0, 0] when field is a tile of a larger grid.
+
+    Returns:
+    - directions (ndarray): Gradient direction in degrees of each arrow, shape (n,).
+    - lines (ndarray): Start and end points of each arrow, shape (n, 2, 2).
+    - heads (ndarray): Arrowhead triangles, shape (n, 3, 2).
+    """
+    accepted = (field[:, :, 0] < 0) | (field[:, :, 1] < 0)
+    rows, cols = np.nonzero(accepted)
+    directions = field[rows, cols, 2]
+
+    start_x = (col_offset + cols) * box_size_px + box_size_px // 2
+    start_y = (row_offset + rows) * box_size_px + box_size_px // 2
+    theta = np.radians(directions)
+    end_x = start_x + arrow_size * np.cos(theta)
+    end_y = start_y + arrow_size * np.sin(theta)
+
+    # Arrowhead size scales with the arrow size but a minimum is enforced
+    arrowhead_size = max(min_arrowhead_size, arrow_size * 0.2)
+    left = np.radians(directions - 30)
+    right = np.radians(directions + 30)
+
+    lines = np.stack([np.stack([start_x, start_y], axis=-1),
+                      np.stack([end_x, end_y], axis=-1)], axis=1)
+    heads = np.stack([np.stack([end_x, end_y], axis=-1),
+                      np.stack([end_x - arrowhead_size * np.cos(left), end_y - arrowhead_size * np.sin(left)], axis=-1),
+                      np.stack([end_x - arrowhead_size * np.cos(right), end_y - arrowhead_size * np.sin(right)], axis=-1)], axis=1)
+    return directions, lines, heads
+
+# Define a function to start an SVG file with the background image
+def write_svg_header(svg_file, width, height, image_path, embed_image=False):
+    """
+    Write the opening of the arrow SVG, with the same markup svgwrite produces.
+
+    Parameters:
+    - svg_file (file): Text file opened for writing.
+    - width, height (int): Size of the drawing in pixels.
+    - image_path (str): Background image.
+    - embed_image (bool): Embed the image as a base64 data URI instead of referencing its path.
+    """
+    href = image_path
+    if embed_image:
+        mime_type = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+        with open(image_path, "rb") as image_file:
+            href = f"data:{mime_type};base64," + base64.b64encode(image_file.read()).decode("ascii")
+
+    svg_file.write('<?xml version="1.0" encoding="utf-8" ?>\n'
+                   f'<svg baseProfile="full" height="{height}" version="1.1" width="{width}" '
+                   'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+                   'xmlns:xlink="http://www.w3.org/1999/xlink"><defs />'
+                   f'<image height="{height}" width="{width}" x="0" xlink:href={quoteattr(href)} y="0" />')
+
+# Define a function to stream arrows into an SVG file in batches
+def write_svg_arrows(svg_file, lines, heads, compound_paths=False, batch_size=100000):
+    """
+    Write arrows straight to the SVG file, batch_size arrows per write.
+
+    Parameters:
+    - svg_file (file): Text file opened for writing, after write_svg_header.
+    - lines (ndarray): Start and end points of each arrow, shape (n, 2, 2).
+    - heads (ndarray): Arrowhead triangles, shape (n, 3, 2).
+    - compound_paths (bool): Write each batch as one stroked <path> for the lines and one
+      filled <path> for the heads instead of a <line> and <polygon> per arrow.
+    - batch_size (int): Number of arrows formatted per write.
+    """
+    for start in range(0, len(lines), batch_size):
+        line_batch = lines[start:start + batch_size].reshape(-1, 4).tolist()
+        head_batch = heads[start:start + batch_size].reshape(-1, 6).tolist()
+        if compound_paths:
+            line_data = "".join("M%.3f %.3fL%.3f %.3f" % tuple(line) for line in line_batch)
+            head_data = "".join("M%.3f %.3fL%.3f %.3fL%.3f %.3fZ" % tuple(head) for head in head_batch)
+            svg_file.write(f'<path d="{line_data}" fill="none" stroke="black" stroke-width="2" />'
+                           f'<path d="{head_data}" fill="black" />')
+        else:
+            # Arrows start on whole pixels at the box centre
+            svg_file.write("".join(
+                '<line stroke="black" stroke-width="2" x1="%d" x2="%r" y1="%d" y2="%r" />'
+                '<polygon fill="black" points="%r,%r %r,%r %r,%r" />'
+                % (x1, x2, y1, y2, *head)
+                for (x1, y1, x2, y2), head in zip(line_batch, head_batch)))
+
+# Define a function to close an SVG file
+def write_svg_footer(svg_file):
+    """Write the closing tag of the arrow SVG."""
+    svg_file.write("</svg>")
+
+# Define a function to split arrowheads into batches of triangles that cannot overlap
+def _split_heads_into_batches(head_points, shift, margin=1):
+    """
+    Split arrowheads into batches whose triangles do not touch, one fillPoly call per batch.
+
+    fillPoly fills its polygons with the even-odd rule, so where two heads of one call
+    overlap, the overlap is left unpainted. Heads are binned on a grid of cells larger
+    than the largest head; heads two cells apart cannot overlap, so every batch takes
+    at most one head per cell from one of the four (row % 2, col % 2) cell parities.
+
+    Parameters:
+    - head_points (ndarray): Fixed-point arrowhead triangles, shape (n, 3, 2).
+    - shift (int): Fractional bits of the coordinates.
+    - margin (int): Pixels added around each head (anti-aliasing reaches one pixel further).
+
+    Returns:
+    - batches (list): Index arrays into head_points.
+    """
+    scale = 1 << shift
+    low = head_points.min(axis=1) // scale - margin
+    high = -(-head_points.max(axis=1) // scale) + margin
+    cell = int((high - low).max()) + 1
+    cells = low // cell
+    cells -= cells.min(axis=0)
+
+    # Rank the heads within their cell, then batch by cell parity and rank
+    key = cells[:, 1] * (int(cells[:, 0].max()) + 1) + cells[:, 0]
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+    first = np.searchsorted(sorted_key, sorted_key)
+    rank = np.empty(len(key), dtype=np.int64)
+    rank[order] = np.arange(len(key)) - first
+    batch = rank * 4 + (cells[:, 1] % 2) * 2 + cells[:, 0] % 2
+
+    order = np.argsort(batch, kind="stable")
+    return np.split(order, np.flatnonzero(np.diff(batch[order])) + 1)
+
+# Define a function to draw arrows onto an image array
+def draw_arrows_raster(image, lines, heads, color=(0, 0, 0), thickness=2, antialias=False, shift=4, threads=None):
+    """
+    Draw all arrows onto the image array in place with batched polylines and fillPoly calls.
+
+    Arrowheads are filled in batches of heads that do not overlap (see
+    _split_heads_into_batches), so the result matches drawing every arrow on its own.
+
+    Parameters:
+    - image (ndarray): Image array of shape (height, width, 3) to draw on.
+    - lines (ndarray): Start and end points of each arrow, shape (n, 2, 2).
+    - heads (ndarray): Arrowhead triangles, shape (n, 3, 2).
+    - color (tuple): Arrow color in the channel order of the image.
+    - thickness (int): Line thickness in pixels, as the stroke width of the SVG.
+    - antialias (bool): Draw anti-aliased arrows (slower).
+    - shift (int): Fractional bits used for sub-pixel arrow coordinates.
+    - threads (int): Draw horizontal bands of the image on this many threads (OpenCV
+      releases the GIL while drawing). Defaults to the number of CPUs.
+    """
+    if len(lines) == 0:
+        return image
+    line_type = cv2.LINE_AA if antialias else cv2.LINE_8
+    scale = 1 << shift
+    line_points = np.rint(lines * scale).astype(np.int32)
+    head_points = np.rint(heads * scale).astype(np.int32)
+
+    # Rows covered by each arrow, including the line thickness
+    top = np.minimum(line_points[:, :, 1].min(axis=1), head_points[:, :, 1].min(axis=1)) // scale - thickness
+    bottom = np.maximum(line_points[:, :, 1].max(axis=1), head_points[:, :, 1].max(axis=1)) // scale + thickness
+    margin = int((bottom - top).max()) + 1
+    head_batches = _split_heads_into_batches(head_points, shift)
+
+    def draw_band(y0, y1):
+        # Draw the arrows overlapping rows [y0, y1) into a copy padded so that none of them is clipped
+        selected = (bottom >= y0) & (top < y1)
+        pad_top, pad_bottom = max(0, y0 - margin), min(image.shape[0], y1 + margin)
+        band = image[pad_top:pad_bottom].copy()
+        offset = np.array([0, pad_top * scale], dtype=np.int32)
+        cv2.polylines(band, line_points[selected] - offset, False, color, thickness, line_type, shift)
+        for batch in head_batches:
+            batch = batch[selected[batch]]
+            if len(batch):
+                cv2.fillPoly(band, head_points[batch] - offset, color, line_type, shift)
+        image[y0:y1] = band[y0 - pad_top:y1 - pad_top]
+
+    threads = threads or os.cpu_count()
+    height = image.shape[0]
+    if threads == 1:
+        cv2.polylines(image, line_points, False, color, thickness, line_type, shift)
+        for batch in head_batches:
+            cv2.fillPoly(image, head_points[batch], color, line_type, shift)
+        return image
+
+    edges = np.linspace(0, height, threads + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(draw_band, y0, y1) for y0, y1 in zip(edges[:-1], edges[1:]) if y1 > y0]:
+            future.result()
+    return image
+
+# Define a fixed-bin histogram of arrow directions that can be filled tile by tile
+class AngleHistogram:
+    """
+    Fixed-bin histogram of arrow angles, updated per tile and mergeable across images and processes.
+
+    Angles are binned the same way as np.histogram / plt.hist with the same bins and
+    range, so only the counts are kept instead of every angle.
+
+    Parameters:
+    - bins (int): Number of bins.
+    - angle_range (tuple): Lower and upper edge of the histogram in degrees.
+    """
+
+    def __init__(self, bins=1000, angle_range=(0, 180)):
+        self.bins = bins
+        self.angle_range = (float(angle_range[0]), float(angle_range[1]))
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    @property
+    def edges(self):
+        return np.linspace(self.angle_range[0], self.angle_range[1], self.bins + 1)
+
+    def update(self, angles):
+        """Add an array of angles to the counts. Angles outside the range are ignored."""
+        low, high = self.angle_range
+        angles = np.asarray(angles, dtype=np.float64).ravel()
+        angles = angles[(angles >= low) & (angles <= high)]
+
+        # Bin index as computed by np.histogram for equal bins, including its edge corrections
+        indices = ((angles - low) * (self.bins / (high - low))).astype(np.intp)
+        indices[indices == self.bins] -= 1
+        edges = self.edges
+        indices[angles < edges[indices]] -= 1
+        indices[(angles >= edges[indices + 1]) & (indices != self.bins - 1)] += 1
+
+        self.counts += np.bincount(indices, minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same bins."""
+        if other.bins != self.bins or other.angle_range != self.angle_range:
+            raise ValueError("Cannot merge histograms with different bins.")
+        self.counts += other.counts
+        return self
+
+    def save(self, path):
+        """Save the counts as .npy (counts only) or .csv (bin edges and counts)."""
+        if path.lower().endswith(".csv"):
+            edges = self.edges
+            np.savetxt(path, np.column_stack([edges[:-1], edges[1:], self.counts]), delimiter=",",
+                       header="bin_start,bin_end,count", comments="", fmt=["%.6f", "%.6f", "%d"])
+        else:
+            np.save(path, self.counts)
+
+    @classmethod
+    def load(cls, path, angle_range=(0, 180)):
+        """Load a histogram saved by save. For .npy files the range is not stored and must be given."""
+        if path.lower().endswith(".csv"):
+            table = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+            histogram = cls(len(table), (table[0, 0], table[-1, 1]))
+            histogram.counts[:] = table[:, 2].astype(np.int64)
+        else:
+            counts = np.load(path)
+            histogram = cls(len(counts), angle_range)
+            histogram.counts[:] = counts
+        return histogram
+
+    def plot(self, output_path=None, show=False):
+        """Draw the histogram like plt.hist, saving it to output_path and/or showing it."""
+        edges = self.edges
+        if show:
+            figure = plt.figure(figsize=(8, 5))
+        else:
+            # Figure without pyplot renders headless
+            figure = Figure(figsize=(8, 5))
+        ax = figure.add_subplot()
+        ax.hist(edges[:-1], bins=edges, weights=self.counts, edgecolor='black', alpha=0.75)
+        ax.set_title('Arrow Direction Distribution')
+        ax.set_xlabel('Angle (0° to 180°)')
+        ax.set_ylabel('Count of Arrows')
+        ax.grid(True)
+
+        if output_path:
+            figure.savefig(output_path)
+            print(f"Saved histogram to '{output_path}'")
+        if show:
+            plt.show()
+
 # Define a function to create the SVG file and plot arrow population
-def process_image_to_svg_and_plot(image_path, output_svg_path, grid_size_mm=5, resolution_dpi=300, arrow_size=5):
+def process_image_to_svg_and_plot(image_path, output_svg_path, grid_size_mm=5, resolution_dpi=300, arrow_size=5,
+                                  use_index=False, tile_size_px=None, workers=1, embed_image=False,
+                                  compound_paths=False, output_raster_path=None, histogram=None,
+                                  histogram_path=None):
     """
-    Process the image to analyze color transitions in grid_size_mm x grid_size_mm boxes, 
+    Process the image to analyze color transitions in grid_size_mm x grid_size_mm boxes,
     generate an SVG with arrows, and plot the population density of angles.
-    
+
     Parameters:
     - image_path (str): Path to the input image.
-    - output_svg_path (str): Path to save the output SVG file.
+    - output_svg_path (str): Path to save the output SVG file, or None to skip the SVG.
     - grid_size_mm (int): Size of each grid cell in mm.
     - resolution_dpi (int): Resolution of the image in DPI (dots per inch).
     - arrow_size (int): Length of the arrows in the SVG.
+    - use_index (bool): Read the box gradients from the summed-area table saved next to the
+      image (see build_gradient_index) instead of decoding the image on every run.
+    - tile_size_px (int): If given, stream tiles of this size from a memory-mapped raster of
+      the image (see decode_to_raster) so memory is bounded by the tile size. The first run
+      on a compressed image (JPEG, PNG) still decodes it whole once to build the raster,
+      and output_raster_path always needs the whole image in memory (see below).
+    - workers (int): Number of processes computing the gradient field (see
+      compute_gradient_field_parallel). None uses every CPU.
+    - embed_image (bool): Embed the image in the SVG instead of referencing its path.
+    - compound_paths (bool): Write the arrows as a few compound <path> elements
+      (see write_svg_arrows) instead of a <line> and <polygon> per arrow.
+    - output_raster_path (str): If given, also draw the arrows onto the image and save it
+      here (JPEG, PNG or any format PIL can write). The overlay is drawn on the full RGB
+      image and PIL encodes it in one piece, so this needs the whole decoded image (and
+      its copy for saving) in memory even with tile_size_px or use_index.
+    - histogram (AngleHistogram): Histogram to add this image's arrow angles to, e.g. to
+      combine several images. A new one is created if not given.
+    - histogram_path (str): If given, save the histogram plot here instead of showing it.
+
+    Returns:
+    - field (ndarray): Per-box mean_dx, mean_dy and direction, see compute_gradient_field.
+      In tiled mode this is a memmap saved as "<output path without extension>_field.npy".
+    - histogram (AngleHistogram): Histogram of the arrow angles.
     """
     # Convert mm to pixels using the DPI (dots per inch) of the image
     mm_to_inch = 25.4
     box_size_px = int((grid_size_mm / mm_to_inch) * resolution_dpi)
 
-    # Load the image and convert to RGB
-    img = Image.open(image_path).convert("RGB")
-    img_np = np.array(img)
-    height, width, _ = img_np.shape
-
-    # Create the SVG drawing
-    dwg = svgwrite.Drawing(output_svg_path, size=(width, height))
-    dwg.add(dwg.image(image_path, insert=(0, 0), size=(width, height)))
-
-    # Define minimum arrowhead size
-    min_arrowhead_size = 5  # Minimum size for the arrowhead
-
-    # List to store angles for histogram
-    angles_list = []
-
-    # Iterate through each box in the grid
-    for y in range(0, height, box_size_px):
-        for x in range(0, width, box_size_px):
-            # Extract the current box
-            box = img_np[y:y + box_size_px, x:x + box_size_px]
-
-            # Compute gradients in the box using numpy's gradient function for the red channel
-            red_channel = box[:, :, 0]  # Extract the red channel
-            gradient_y, gradient_x = np.gradient(red_channel)
-
-            # Compute the mean gradient in the x and y directions
-            mean_dx = np.mean(gradient_x)
-            mean_dy = np.mean(gradient_y)
-
-            # Only proceed if the gradient indicates a transition from lighter red to deeper red
-            if mean_dx < 0 or mean_dy < 0:
-                # Calculate the gradient direction
-                gradient_direction = compute_gradient_direction(mean_dx, mean_dy)
-
-                # Convert gradient direction to the range [0, 180] degrees for the histogram
-                angle_180 = gradient_direction % 180
-                angles_list.append(angle_180)
-
-                # Determine the arrow direction and length
-                start_x = x + box_size_px // 2
-                start_y = y + box_size_px // 2
-                end_x = start_x + arrow_size * math.cos(math.radians(gradient_direction))
-                end_y = start_y + arrow_size * math.sin(math.radians(gradient_direction))
-
-                # Draw the arrow as a line
-                line = dwg.line(start=(start_x, start_y), end=(end_x, end_y), stroke='black', stroke_width=2)
-                dwg.add(line)
-
-                # Calculate dynamic arrowhead size based on the size of the grid box
-                arrowhead_size = max(min_arrowhead_size, arrow_size * 0.2)  # Scale based on arrow size but enforce minimum
-
-                # Create an arrowhead at the end point
-                arrowhead = dwg.polygon(
-                    points=[
-                        (end_x, end_y),
-                        (end_x - arrowhead_size * math.cos(math.radians(gradient_direction - 30)),
-                         end_y - arrowhead_size * math.sin(math.radians(gradient_direction - 30))),
-                        (end_x - arrowhead_size * math.cos(math.radians(gradient_direction + 30)),
-                         end_y - arrowhead_size * math.sin(math.radians(gradient_direction + 30)))
-                    ],
-                    fill='black'
-                )
-                dwg.add(arrowhead)
-
-    # Save the SVG
-    dwg.save()
-
-    # Create the histogram of angles
-    plt.figure(figsize=(8, 5))
-    plt.hist(angles_list, bins=1000, range=(0, 180), edgecolor='black', alpha=0.75)
-    plt.title('Arrow Direction Distribution')
-    plt.xlabel('Angle (0° to 180°)')
-    plt.ylabel('Count of Arrows')
-    plt.grid(True)
-
-    # Show the plot
-    plt.show()
+    if tile_size_px:
+        # Stream the gradient field tile by tile from the decoded raster
+        raster = decode_to_raster(image_path)
+        height, width = raster.shape
+        field_path = os.path.splitext(output_svg_path or output_raster_path or image_path)[0] + "_field.npy"
+        field = np.lib.format.open_memmap(field_path, mode="w+",
+                                          dtype=np.float64, shape=(-(-height // box_size_px), -(-width // box_size_px), 3))
+        tiles = iter_gradient_field_tiles(raster, box_size_px, tile_size_px)
+    elif use_index:
+        # Read the gradient field from the precomputed index
+        sat = load_gradient_index(image_path)
+        height, width = sat.shape[0] - 1, sat.shape[1] - 1
+        field = compute_gradient_field_from_index(sat, box_size_px)
+        tiles = [(0, 0, field)]
+    else:
+        # Load the image and convert to RGB
+        img = Image.open(image_path).convert("RGB")
+        img_np = np.array(img)
+        height, width, _ = img_np.shape
+
+        # Compute the gradient field of the red channel for all boxes at once
+        if workers == 1:
+            field = compute_gradient_field(img_np[:, :, 0], box_size_px)
+        else:
+            field = compute_gradient_field_parallel(np.ascontiguousarray(img_np[:, :, 0]), box_size_px, workers)
+        tiles = [(0, 0, field)]
+
+    # Image to draw the raster overlay on; it is decoded whole even in tiled mode
+    overlay = None
+    if output_raster_path:
+        overlay = img_np if not (tile_size_px or use_index) else np.array(Image.open(image_path).convert("RGB"))
+
+    # Histogram of the arrow angles, filled tile by tile
+    if histogram is None:
+        histogram = AngleHistogram()
+
+    # Stream the SVG straight to the file, one batch of arrows at a time
+    svg_file = open(output_svg_path, "w", encoding="utf-8") if output_svg_path else None
+    try:
+        if svg_file:
+            write_svg_header(svg_file, width, height, image_path, embed_image)
+
+        for row, col, field_tile in tiles:
+            if field_tile is not field:
+                field[row:row + field_tile.shape[0], col:col + field_tile.shape[1]] = field_tile
+
+            # Arrows for the boxes with a transition from lighter red to deeper red
+            directions, lines, heads = compute_arrow_geometry(field_tile, box_size_px, arrow_size,
+                                                              row_offset=row, col_offset=col)
+            if svg_file:
+                write_svg_arrows(svg_file, lines, heads, compound_paths)
+            if overlay is not None:
+                draw_arrows_raster(overlay, lines, heads)
+
+            # Convert gradient directions to the range [0, 180] degrees for the histogram
+            histogram.update(directions % 180)
+
+        if svg_file:
+            write_svg_footer(svg_file)
+    finally:
+        if svg_file:
+            svg_file.close()
+
+    # Save the raster overlay
+    if overlay is not None:
+        Image.fromarray(overlay).save(output_raster_path)
+        print(f"Saved arrow overlay to '{output_raster_path}'")
+
+    # Plot the histogram of angles
+    histogram.plot(histogram_path, show=histogram_path is None)
+
+    return field, histogram
+
+# Define a function to hash the content of a file for the result cache
+def _file_digest(path, chunk_size=1 << 20):
+    """SHA-256 hex digest of the file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Define a function to write a cache file atomically
+def _write_atomic(path, write):
+    """Call write(tmp_path) and move the result to path, so readers never see a partial file."""
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.tmp{ext}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+# Define a worker that processes one image of a batch through the result cache
+def _process_image_cached(image_path, output_dir, cache_dir, grid_size_mm, resolution_dpi, arrow_size, outputs):
+    """
+    Produce the outputs of one image, reusing every stage already cached for its content.
+
+    The field and histogram are keyed by the box size, the rendered arrows also by the
+    arrow size (and the SVG by its image reference), so changing arrow_size only
+    re-renders and changing the grid recomputes the field.
+    """
+    mm_to_inch = 25.4
+    box_size_px = int((grid_size_mm / mm_to_inch) * resolution_dpi)
+    entry = os.path.join(cache_dir, _file_digest(image_path))
+    os.makedirs(entry, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    computed = []
+
+    # Stage 1: gradient field and histogram counts
+    field_path = os.path.join(entry, f"field_{box_size_px}.npy")
+    counts_path = os.path.join(entry, f"histogram_{box_size_px}.npy")
+    img_np = None
+    if os.path.exists(field_path) and os.path.exists(counts_path):
+        field = np.load(field_path, mmap_mode="r")
+        histogram = AngleHistogram.load(counts_path)
+    else:
+        img_np = np.array(Image.open(image_path).convert("RGB"))
+        field = compute_gradient_field(img_np[:, :, 0], box_size_px)
+        accepted = (field[:, :, 0] < 0) | (field[:, :, 1] < 0)
+        histogram = AngleHistogram().update(field[:, :, 2][accepted] % 180)
+        _write_atomic(field_path, lambda path: np.save(path, field))
+        _write_atomic(counts_path, histogram.save)
+        computed.append("field")
+
+    # Stage 2: rendered outputs
+    geometry = None
+    svg_href = os.path.relpath(os.path.abspath(image_path), os.path.abspath(output_dir))
+    renders = {
+        "svg": (f"arrows_{box_size_px}_{arrow_size:g}_{hashlib.sha1(svg_href.encode()).hexdigest()[:8]}.svg", f"{stem}_arrows.svg"),
+        "png": (f"arrows_{box_size_px}_{arrow_size:g}.png", f"{stem}_arrows.png"),
+        "histogram": (f"histogram_{box_size_px}.png", f"{stem}_histogram.png"),
+    }
+    for kind in outputs:
+        cached_name, output_name = renders[kind]
+        cached_path = os.path.join(entry, cached_name)
+        if not os.path.exists(cached_path):
+            if kind == "histogram":
+                _write_atomic(cached_path, histogram.plot)
+            else:
+                if geometry is None:
+                    geometry = compute_arrow_geometry(field, box_size_px, arrow_size)
+                if img_np is None:
+                    img_np = np.array(Image.open(image_path).convert("RGB"))
+                height, width, _ = img_np.shape
+                if kind == "svg":
+                    def write_svg(path):
+                        with open(path, "w", encoding="utf-8") as svg_file:
+                            write_svg_header(svg_file, width, height, svg_href)
+                            write_svg_arrows(svg_file, geometry[1], geometry[2])
+                            write_svg_footer(svg_file)
+                    _write_atomic(cached_path, write_svg)
+                else:
+                    overlay = draw_arrows_raster(img_np.copy(), geometry[1], geometry[2], threads=1)
+                    _write_atomic(cached_path, lambda path: Image.fromarray(overlay).save(path))
+            computed.append(kind)
+        shutil.copyfile(cached_path, os.path.join(output_dir, output_name))
+
+    return image_path, histogram.counts, computed
+
+# Define a function to process a whole folder of images in parallel with a result cache
+def process_directory(input_dir, output_dir, grid_size_mm=5, resolution_dpi=300, arrow_size=5, workers=None,
+                      cache_dir=None, outputs=("svg", "png", "histogram")):
+    """
+    Process every image of a folder on a pool of processes, caching results by image content.
+
+    Results are cached under the SHA-256 of the image content plus the parameters, so
+    unchanged images are skipped and a parameter change only redoes the stages it
+    affects. A combined histogram of all images is written to the output folder.
+
+    Parameters:
+    - input_dir (str): Folder with the input images.
+    - output_dir (str): Folder for the per-image outputs and the combined histogram.
+    - grid_size_mm, resolution_dpi, arrow_size: As in process_image_to_svg_and_plot.
+    - workers (int): Number of worker processes. Defaults to the number of CPUs.
+    - cache_dir (str): Result cache folder. Defaults to "<output_dir>/.heatmap_cache".
+    - outputs (tuple): Any of "svg", "png" (raster overlay) and "histogram".
+
+    Returns:
+    - histogram (AngleHistogram): Combined histogram of the arrow angles of all images.
+    """
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"Error: Folder '{input_dir}' not found.")
+    image_paths = [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir))
+                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff'))]
+    if not image_paths:
+        raise ValueError("Error: No valid images found in the folder.")
+
+    cache_dir = cache_dir or os.path.join(output_dir, ".heatmap_cache")
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    histogram = AngleHistogram()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_process_image_cached, image_path, output_dir, cache_dir, grid_size_mm,
+                                   resolution_dpi, arrow_size, tuple(outputs)) for image_path in image_paths]
+        for future in futures:
+            image_path, counts, computed = future.result()
+            histogram.counts += counts
+            status = f"computed {', '.join(computed)}" if computed else "cached"
+            print(f"Processed {os.path.basename(image_path)} ({status})")
+
+    histogram.save(os.path.join(output_dir, "combined_histogram.csv"))
+    histogram.plot(os.path.join(output_dir, "combined_histogram.png"))
+    return histogram
 
 # Example usage:
-process_image_to_svg_and_plot("Image_analysis/ESA_Planck_CMB.jpg", "output_with_arrows.svg", grid_size_mm=0.2, resolution_dpi=300, arrow_size=0.2)
+if __name__ == "__main__":
+    process_image_to_svg_and_plot("Image_analysis/ESA_Planck_CMB.jpg", "output_with_arrows.svg", grid_size_mm=0.2, resolution_dpi=300, arrow_size=0.2)
@@ -1,8 +1,15 @@
 import cv2
 import numpy as np
 import os
+from multi_image_to_single_image_v3 import load_image  # Shared with the v3 blends
 
-def blend_images_with_opacity(folder_path, output_image_path):
+def blend_images_with_opacity(folder_path, output_image_path, roi=None, scale=None):
+    """
+    Blend all images in a folder into one image with opacity falling from 100% to 50%.
+
+    roi (x, y, width, height) and scale crop and shrink every image as it is loaded
+    (see load_image), e.g. scale=0.25 for a quick preview.
+    """
     # Verify the folder exists
     if not os.path.isdir(folder_path):
         raise FileNotFoundError(f"Error: Folder '{folder_path}' not found.")
@@ -17,7 +24,7 @@ def blend_images_with_opacity(folder_path, output_image_path):
     # Load images
     images = []
     for image_file in image_files:
-        img = cv2.imread(image_file)
+        img = load_image(image_file, roi, scale)
         if img is not None:
             images.append(img)
             print(f"Loaded image: {os.path.basename(image_file)} ({img.shape})")
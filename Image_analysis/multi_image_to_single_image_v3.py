@@ -0,0 +1,500 @@
+import cv2
+import json
+import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+def load_image(image_file, roi=None, scale=None):
+    """
+    Load an image, cropped to roi and scaled by scale.
+
+    For scales of 1/2 or less the image is decoded at reduced resolution
+    (cv2.IMREAD_REDUCED_COLOR_2/4/8; JPEG decodes these natively), so neither the
+    decode nor the blend touches the full-size pixels.
+
+    Parameters:
+    - image_file (str): Path to the image.
+    - roi (tuple): (x, y, width, height) of the region to keep, in full-size pixels.
+    - scale (float): Scale factor applied to the (cropped) image.
+
+    Returns:
+    - img (ndarray): The prepared image, or None if it can't be loaded.
+
+    Raises:
+    - ValueError: If the ROI is not inside the image, as vid_to_img_v4.get_output_size does.
+    """
+    # Pick the largest reduced decode that is still at least the output size
+    reduction, flag = 1, cv2.IMREAD_COLOR
+    if scale is not None:
+        for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                     (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if factor * scale <= 1:
+                reduction, flag = factor, reduced_flag
+                break
+
+    img = cv2.imread(image_file, flag)
+    if img is None:
+        return None
+
+    # Crop the ROI in the coordinates of the decoded image
+    height, width = img.shape[0] * reduction, img.shape[1] * reduction
+    if roi is not None:
+        if reduction > 1:
+            # Reduced decodes round the size up or down depending on the codec, so check the
+            # ROI against the full size from the header
+            try:
+                with Image.open(image_file) as header:
+                    width, height = header.size
+            except OSError:
+                pass
+        x, y, roi_width, roi_height = roi
+        if x < 0 or y < 0 or roi_width <= 0 or roi_height <= 0 or x + roi_width > width or y + roi_height > height:
+            raise ValueError(f"ROI {roi} is not inside the {width}x{height} image '{image_file}'.")
+        width, height = roi_width, roi_height
+        # Copy the crop so the full decoded image can be freed
+        img = np.ascontiguousarray(img[y // reduction:-(-(y + height) // reduction),
+                                       x // reduction:-(-(x + width) // reduction)])
+
+    if scale is not None:
+        output_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if output_size != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, output_size, interpolation=cv2.INTER_AREA)
+    return img
+
+def _load_and_resize(image_file, roi, scale, base_size):
+    """Load one image for iter_loaded_images and return (img, error)."""
+    try:
+        img = load_image(image_file, roi, scale)
+    except cv2.error as e:
+        return None, str(e)
+    if img is None:
+        return None, "not a readable image"
+
+    # Resize to the size of the first image once it is known
+    if base_size and (img.shape[1], img.shape[0]) != base_size[0]:
+        img = cv2.resize(img, base_size[0])
+    return img, None
+
+def iter_loaded_images(image_files, roi=None, scale=None, workers=None, prefetch=16, base_size=None):
+    """
+    Load images on a thread pool ahead of the blend, yielding them in the order of image_files.
+
+    cv2.imread and cv2.resize release the GIL, so the threads decode in parallel. At most
+    prefetch images are loaded ahead of the consumer, which bounds the memory. Once the
+    first image is loaded, the threads also resize the following images to its size.
+
+    Parameters:
+    - image_files (list): Paths of the images.
+    - roi (tuple), scale (float): As in load_image.
+    - workers (int): Number of loader threads (default: ThreadPoolExecutor's default).
+    - prefetch (int): Maximum number of images loaded ahead.
+    - base_size (tuple): (width, height) to resize every image to, instead of the size of the first one.
+
+    Yields:
+    - (image_file, img, error): The image, or None and the reason it could not be loaded.
+    """
+    base_size = [base_size] if base_size else []  # Else filled in with the size of the first loaded image
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        files = iter(image_files)
+        try:
+            for image_file in files:
+                pending.append((image_file, executor.submit(_load_and_resize, image_file, roi, scale, base_size)))
+                if len(pending) >= prefetch:
+                    break
+            while pending:
+                image_file, future = pending.popleft()
+                img, error = future.result()
+                if img is not None and not base_size:
+                    base_size.append((img.shape[1], img.shape[0]))
+                next_file = next(files, None)
+                if next_file is not None:
+                    pending.append((next_file, executor.submit(_load_and_resize, next_file, roi, scale, base_size)))
+                yield image_file, img, error
+        finally:
+            # Don't load the rest if the consumer stops early
+            for image_file, future in pending:
+                future.cancel()
+
+def list_image_files(folder_path):
+    """Return the image files of a folder, sorted by name (os.listdir order is arbitrary)."""
+    # Verify the folder exists
+    if not os.path.isdir(folder_path):
+        raise FileNotFoundError(f"Error: Folder '{folder_path}' not found.")
+
+    # Get list of image files from folder
+    return [os.path.join(folder_path, f) for f in sorted(os.listdir(folder_path)) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+
+def save_blended_image(output_image_path, blended_image):
+    """Save the blended image, creating the output directory if needed and falling back to .png."""
+    # Ensure the output directory exists, or create it if necessary
+    output_dir = os.path.dirname(output_image_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"Created output directory: {output_dir}")
+
+    # Convert to absolute path
+    output_image_path = os.path.abspath(output_image_path)
+    print(f"Attempting to save combined image at: {output_image_path}")
+
+    # Save the blended image as .jpg
+    success = cv2.imwrite(output_image_path, blended_image)
+    
+    if not success:
+        # Try saving as .png if .jpg fails
+        output_image_path = output_image_path.replace('.jpg', '.png')
+        print(f"Warning: Failed to save as .jpg. Trying to save as .png at {output_image_path}")
+        success = cv2.imwrite(output_image_path, blended_image)
+
+    if success:
+        print(f"Successfully saved the blended image to '{output_image_path}'")
+    else:
+        raise IOError(f"Error: Failed to save the blended image to '{output_image_path}'")
+
+def blend_images_from_folder(folder_path, output_image_path, scheme="equal", roi=None, scale=None, workers=None,
+                             prefetch=16):
+    """
+    Blend all images in a folder into one image, reading and accumulating one image at a time.
+
+    Only the accumulator and the current image are in memory, instead of every image twice
+    (loaded and resized) as in multi_image_to_single_image.py and _v2.py. The blend is the
+    same fold of cv2.addWeighted over float64 that those scripts run, done in place, so the
+    output is identical to theirs. The accumulator stays float64 because the uint8
+    conversion at the end truncates: a float32 fold shifts some pixels by one level.
+
+    The blend weights depend on the number of images, which is taken to be the number of
+    image files. If some of them can't be loaded, the blend is run again without them.
+
+    Parameters:
+    - folder_path (str): Folder with the images (.png, .jpg, .jpeg, .bmp).
+    - output_image_path (str): Path to save the blended image.
+    - scheme (str): "equal" (multi_image_to_single_image.py) or "opacity", from 100% down
+      to 50% (multi_image_to_single_image_v2.py).
+    - roi (tuple), scale (float): Crop and shrink every image as it is loaded (see load_image).
+    - workers (int), prefetch (int): Loader threads and images loaded ahead (see iter_loaded_images).
+
+    Returns:
+    - blended_image (ndarray): The blended image.
+    """
+    if scheme not in ("equal", "opacity"):
+        raise ValueError(f"Unknown blend scheme '{scheme}'.")
+
+    image_files = list_image_files(folder_path)
+
+    # Check if there are any valid images
+    if not image_files:
+        raise ValueError("Error: No valid images found in the folder.")
+
+    # Blend, and blend again without the images that failed to load
+    while True:
+        blended_image, failed_files = blend_image_files(image_files, scheme, roi, scale, workers, prefetch)
+        if not failed_files:
+            break
+        image_files = [f for f in image_files if f not in failed_files]
+        if not image_files:
+            raise RuntimeError("Error: No images could be loaded.")
+        print(f"Blending again without the {len(failed_files)} images that failed to load.")
+
+    # Normalize values to valid image range [0, 255]
+    blended_image = np.clip(blended_image, 0, 255, out=blended_image).astype(np.uint8)
+
+    save_blended_image(output_image_path, blended_image)
+    return blended_image
+
+def blend_image_files(image_files, scheme="equal", roi=None, scale=None, workers=None, prefetch=16):
+    """
+    Blend the image files in order into one float64 accumulator, assuming all of them load.
+
+    The images are loaded ahead by iter_loaded_images, resized to the size of the first one
+    and folded in with an in-place cv2.addWeighted. "equal" gives each image 1/N weight
+    against the blend so far; "opacity" adds the images with weights falling from 1.0 by
+    0.5/(N-1) per image.
+
+    Returns:
+    - (blended_image, failed_files): The float64 blend and a dict of the files that could
+      not be loaded, with the reason.
+    """
+    num_images = len(image_files)
+    alpha = 1.0 / num_images  # Equal contribution from each image
+    alpha_step = 0.5 / (num_images - 1) if num_images > 1 else 0.0
+    current_alpha = 1.0
+
+    blended_image = None
+    failed_files = {}
+    for image_file, img, error in iter_loaded_images(image_files, roi, scale, workers, prefetch):
+        if img is None:
+            print(f"Warning: Failed to load image '{image_file}' ({error}). Skipping.")
+            failed_files[image_file] = error
+            continue
+        print(f"Loaded image: {os.path.basename(image_file)} ({img.shape})")
+
+        # Start with the first image
+        if blended_image is None:
+            blended_image = img.astype(np.float64)
+            base_height, base_width = img.shape[:2]
+            continue
+
+        # Resize to match the size of the first image (for uniformity)
+        if img.shape[:2] != (base_height, base_width):
+            img = cv2.resize(img, (base_width, base_height))
+        if scheme == "equal":
+            cv2.addWeighted(blended_image, 1 - alpha, img, alpha, 0, dst=blended_image, dtype=cv2.CV_64F)
+        else:
+            cv2.addWeighted(blended_image, 1.0, img, current_alpha, 0, dst=blended_image, dtype=cv2.CV_64F)
+            current_alpha = max(0.5, current_alpha - alpha_step)  # Gradually decrease opacity
+
+    return blended_image, failed_files
+
+def load_blend_state(state_path):
+    """
+    Load the state saved by blend_images_incremental.
+
+    Returns:
+    - (arrays, manifest): Dict of the accumulators and the manifest, or (None, None) if there is no state.
+    """
+    if not os.path.exists(state_path + ".json"):
+        return None, None
+    with open(state_path + ".json") as f:
+        manifest = json.load(f)
+    with np.load(os.path.join(os.path.dirname(state_path), manifest["arrays"])) as data:
+        arrays = {name: data[name] for name in data.files}
+    return arrays, manifest
+
+def save_blend_state(state_path, arrays, manifest):
+    """
+    Save the accumulators to <state_path>.<generation>.npz and the manifest to <state_path>.json.
+
+    The JSON is replaced atomically after the arrays are written, so an interrupted save
+    leaves the previous state readable.
+    """
+    generation = manifest.get("generation", 0) + 1
+    arrays_path = f"{state_path}.{generation}.npz"
+    np.savez(arrays_path, **arrays)
+    manifest = dict(manifest, generation=generation, arrays=os.path.basename(arrays_path))
+    with open(state_path + ".json.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(state_path + ".json.tmp", state_path + ".json")
+
+    # The previous generation is no longer referenced
+    previous_path = f"{state_path}.{generation - 1}.npz"
+    if os.path.exists(previous_path):
+        os.remove(previous_path)
+    return manifest
+
+def blend_images_incremental(folder_path, output_image_path, state_path=None, roi=None, scale=None, workers=None,
+                             prefetch=16):
+    """
+    Opacity blend (as multi_image_to_single_image_v2.py) of a growing folder, folding in
+    only the images added since the last call.
+
+    With N images the opacity blend is I0 + sum(I_i * (1 - (i-1) * step)) for i = 1..N-1,
+    with step = 0.5 / (N-1). Only step depends on N, so the state keeps the first image and
+    two exact integer sums, S1 = sum(I_i) and S2 = sum((i-1) * I_i), and the blend is
+    I0 + S1 - step * S2. New files must sort after the ones already blended; if a blended
+    file changed, was removed, or a new one sorts before them, everything is blended again.
+
+    The result can differ from the sequential cv2.addWeighted fold of blend_images_from_folder
+    by one level in a few pixels, from floating-point rounding. The "equal" scheme can't be
+    updated this way, because every one of its weights depends on N.
+
+    Parameters:
+    - folder_path (str): Folder with the images (.png, .jpg, .jpeg, .bmp).
+    - output_image_path (str): Path to save the blended image.
+    - state_path (str): Path of the state without extension (default: <folder>/.blend_state).
+    - roi, scale, workers, prefetch: As in blend_images_from_folder.
+
+    Returns:
+    - blended_image (ndarray): The blended image.
+    """
+    image_files = list_image_files(folder_path)
+    if not image_files:
+        raise ValueError("Error: No valid images found in the folder.")
+    state_path = state_path or os.path.join(folder_path, ".blend_state")
+
+    # Describe the files so changes can be detected
+    files = []
+    for image_file in image_files:
+        info = os.stat(image_file)
+        files.append({"name": os.path.basename(image_file), "size": info.st_size, "mtime": info.st_mtime})
+    settings = {"roi": list(roi) if roi is not None else None, "scale": scale}
+
+    # Continue from the saved state if the blended files are unchanged and come first
+    arrays, manifest = load_blend_state(state_path)
+    if manifest is not None:
+        blended = manifest["files"]
+        known = [{key: entry[key] for key in ("name", "size", "mtime")} for entry in blended]
+        if manifest["settings"] != settings or files[:len(blended)] != known:
+            print("Blended files changed since the last blend. Blending all images again.")
+            arrays, manifest = None, None
+    if manifest is None:
+        manifest = {"settings": settings, "files": [], "count": 0}
+
+    new_files = image_files[len(manifest["files"]):]
+    print(f"Blending {len(new_files)} new images into {manifest['count']} blended images.")
+    base_size = (arrays["first"].shape[1], arrays["first"].shape[0]) if arrays else None
+    count = manifest["count"]  # Images in the blend
+    for image_file, img, error in iter_loaded_images(new_files, roi, scale, workers, prefetch, base_size):
+        entry = files[len(manifest["files"])]
+        manifest["files"].append(dict(entry, loaded=img is not None))
+        if img is None:
+            print(f"Warning: Failed to load image '{image_file}' ({error}). Skipping.")
+            continue
+        print(f"Loaded image: {os.path.basename(image_file)} ({img.shape})")
+
+        if arrays is None:
+            arrays = {"first": img, "sum": np.zeros(img.shape, dtype=np.uint32),
+                      "ranked_sum": np.zeros(img.shape, dtype=np.uint64)}
+        elif img.shape[:2] != arrays["first"].shape[:2]:
+            img = cv2.resize(img, (arrays["first"].shape[1], arrays["first"].shape[0]))
+        if count > 0:
+            np.add(arrays["sum"], img, out=arrays["sum"])
+            np.add(arrays["ranked_sum"], img.astype(np.uint64) * (count - 1), out=arrays["ranked_sum"])
+        count += 1
+
+    if arrays is None:
+        raise RuntimeError("Error: No images could be loaded.")
+    manifest["count"] = count
+    if new_files:
+        save_blend_state(state_path, arrays, manifest)
+
+    # Blend with the weights for the current number of images
+    blended_image = arrays["first"].astype(np.float64)
+    if count > 1:
+        blended_image += arrays["sum"]
+        blended_image -= (0.5 / (count - 1)) * arrays["ranked_sum"]
+    blended_image = np.clip(blended_image, 0, 255, out=blended_image).astype(np.uint8)
+    save_blended_image(output_image_path, blended_image)
+    return blended_image
+
+def _open_tiled_input(path, cache_dir, base_size=None):
+    """
+    Prepare one input of blend_images_tiled and return the path of its .npy and its shape,
+    or None if it is not a readable image. .npy inputs are used directly; other images are
+    decoded once, resized to base_size and cached as .npy in cache_dir.
+
+    The arrays are not kept mapped: every memory map holds a file descriptor, which runs
+    out with thousands of inputs, so blend_images_tiled maps them one tile at a time.
+    """
+    if path.lower().endswith(".npy"):
+        return path, np.load(path, mmap_mode="r").shape
+
+    cache_path = os.path.join(cache_dir, os.path.basename(path) + ".npy")
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        shape = np.load(cache_path, mmap_mode="r").shape
+        if base_size is None or (shape[1], shape[0]) == base_size:
+            return cache_path, shape
+
+    # Decode the image into the cache
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    if base_size and (img.shape[1], img.shape[0]) != base_size:
+        img = cv2.resize(img, base_size)
+    np.save(cache_path, img)
+    return cache_path, img.shape
+
+def _read_tile(array_path, tile):
+    """Read one tile of a .npy input, keeping the file mapped only while the tile is copied."""
+    return np.ascontiguousarray(np.load(array_path, mmap_mode="r")[tile])
+
+def blend_images_tiled(folder_path, output_image_path, scheme="equal", tile_rows=1024, tile_cols=None,
+                       cache_dir=None, write_image=True):
+    """
+    Blend images that don't fit in memory at float precision, one tile at a time.
+
+    Every input is read from a .npy: .npy files in the folder directly, other images
+    after one decode into a uint8 cache (cv2 can't decode part of a JPEG or PNG, so this
+    is the only step that holds a whole image, once per input and only as uint8). Each
+    output tile is then blended from the matching tiles of all inputs, with the same
+    per-pixel fold as blend_image_files, and written straight into a memory-mapped .npy
+    output. The output is identical to blend_images_from_folder, and the float64 memory is
+    one tile (tile_rows x tile_cols) instead of the whole image. Inputs are only mapped
+    while one of their tiles is read, so the number of inputs is not limited by the number
+    of open files.
+
+    Parameters:
+    - folder_path (str): Folder with the images (.png, .jpg, .jpeg, .bmp) and/or .npy arrays.
+    - output_image_path (str): Path to save the blended image; the tiles go to the .npy next to it.
+    - scheme (str): "equal" or "opacity", as in blend_images_from_folder.
+    - tile_rows (int): Rows per tile.
+    - tile_cols (int): Columns per tile (default: the full width, so tiles are contiguous on disk).
+    - cache_dir (str): Folder for the decoded inputs (default: <folder>/.tile_cache). Reused
+      while newer than the images.
+    - write_image (bool): Also encode output_image_path from the .npy. The encoder reads the
+      whole uint8 image, so leave this off for outputs larger than memory.
+
+    Returns:
+    - blended_image (memmap): The blended image, mapped from the .npy output.
+    """
+    if scheme not in ("equal", "opacity"):
+        raise ValueError(f"Unknown blend scheme '{scheme}'.")
+    input_files = sorted(list_image_files(folder_path) + [
+        os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(".npy")])
+    if not input_files:
+        raise ValueError("Error: No valid images found in the folder.")
+    cache_dir = cache_dir or os.path.join(folder_path, ".tile_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Collect the .npy paths of the inputs; the first one sets the size of the blend.
+    # OS errors (e.g. running out of file descriptors) are not a bad image, so they are raised.
+    inputs = []
+    base_size = None
+    for path in input_files:
+        try:
+            prepared = _open_tiled_input(path, cache_dir, base_size)
+        except (cv2.error, ValueError) as e:
+            prepared, error = None, str(e)
+        else:
+            error = "not a readable image"
+        if prepared is None:
+            print(f"Warning: Failed to load image '{path}' ({error}). Skipping.")
+            continue
+        array_path, shape = prepared
+        if base_size is None:
+            base_size, base_shape = (shape[1], shape[0]), shape
+        elif shape != base_shape:
+            print(f"Warning: '{path}' is {shape}, not {base_shape}. Skipping.")
+            continue
+        inputs.append(array_path)
+    if not inputs:
+        raise RuntimeError("Error: No images could be loaded.")
+    print(f"Blending {len(inputs)} images of {base_size[0]}x{base_size[1]} in tiles of {tile_rows} rows.")
+
+    num_images = len(inputs)
+    alpha = 1.0 / num_images  # Equal contribution from each image
+    alpha_step = 0.5 / (num_images - 1) if num_images > 1 else 0.0
+
+    # Blend tile by tile into the memory-mapped output
+    output_dir = os.path.dirname(output_image_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    array_path = os.path.splitext(output_image_path)[0] + ".npy"
+    blended_image = np.lib.format.open_memmap(array_path, mode="w+", dtype=np.uint8, shape=base_shape)
+    height, width = base_shape[:2]
+    tile_cols = tile_cols or width
+    for row in range(0, height, tile_rows):
+        for col in range(0, width, tile_cols):
+            tile = (slice(row, row + tile_rows), slice(col, col + tile_cols))
+            blended_tile = _read_tile(inputs[0], tile).astype(np.float64)
+            current_alpha = 1.0
+            for array_path in inputs[1:]:
+                img = _read_tile(array_path, tile)
+                if scheme == "equal":
+                    cv2.addWeighted(blended_tile, 1 - alpha, img, alpha, 0, dst=blended_tile, dtype=cv2.CV_64F)
+                else:
+                    cv2.addWeighted(blended_tile, 1.0, img, current_alpha, 0, dst=blended_tile, dtype=cv2.CV_64F)
+                    current_alpha = max(0.5, current_alpha - alpha_step)  # Gradually decrease opacity
+            blended_image[tile] = np.clip(blended_tile, 0, 255, out=blended_tile)
+        print(f"Blended rows {row}-{min(row + tile_rows, height)} of {height}")
+    blended_image.flush()
+    print(f"Saved the blended tiles to '{array_path}'")
+
+    if write_image:
+        save_blended_image(output_image_path, blended_image)
+    return blended_image
+
+# Example usage:
+if __name__ == "__main__":
+    blend_images_from_folder('Image_analysis/Burst', 'output/blended_output_image_v3.png', scheme="opacity")
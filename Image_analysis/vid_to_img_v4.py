@@ -0,0 +1,965 @@
+import cv2
+import json
+import numpy as np
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+def set_fps_interval(video_fps, target_fps):
+    """
+    Calculates the frame interval based on the desired FPS.
+    If video is at 60fps and target is 2fps, this function will
+    return an interval of 30, meaning we will take 1 frame every 30 frames.
+    """
+    if target_fps <= 0:
+        raise ValueError("Target FPS must be a positive value.")
+    return int(video_fps / target_fps)
+
+def set_video_duration(total_frames, video_fps, duration):
+    """
+    Calculates the maximum frame count based on the desired duration (in seconds).
+    If duration is 10 seconds and FPS is 30, then max frame count is 300.
+    """
+    if duration <= 0:
+        raise ValueError("Duration must be a positive value.")
+    return min(total_frames, int(video_fps * duration))
+
+def calculate_opacity_weight(index, total_frames):
+    """
+    Calculate opacity weight for each frame based on its index.
+    Starts from 1 (100% opacity) and decreases to 0.5 (50% opacity).
+    """
+    return 1.0 - (0.5 * (index / total_frames))
+
+# Reducers combine the sampled frames into the stacked image. Each one allocates its
+# buffers on the first frame and then accumulates every frame in place. Reducers of
+# separate parts of a video can be combined with merge(), and reducers with
+# checkpoint_fields can be saved and restored (see save_checkpoint).
+class MeanReducer:
+    """
+    Plain average of the stacked frames (vid_to_img.py and vid_to_img_v2.py).
+
+    With an integer accumulator the uint8 frames are added in place into a uint16 buffer,
+    which is flushed into the uint32 sum every 257 frames (before it can overflow), and the
+    division happens once in result(). The sum is exact up to 16 million frames, and the
+    result equals the float32 scripts whenever their float32 sum is exact (65,793 frames).
+
+    Parameters:
+    - dtype: Accumulator type, np.uint32 (default), np.float32 or np.float64.
+    """
+
+    checkpoint_fields = ("count",)
+
+    def __init__(self, dtype=np.uint32):
+        self.dtype = dtype
+        self.stack = None
+        self.batch = None
+        self.batch_count = 0
+        self.count = 0
+
+    def add(self, frame, position):
+        if self.stack is None:
+            self.stack = np.zeros(frame.shape, dtype=self.dtype)
+        if not np.issubdtype(self.stack.dtype, np.integer):
+            cv2.accumulate(frame, self.stack)
+        else:
+            if self.batch is None:
+                self.batch = np.zeros(frame.shape, dtype=np.uint16)
+            np.add(self.batch, frame, out=self.batch)
+            self.batch_count += 1
+            if self.batch_count == 257:
+                self._flush()
+        self.count += 1
+
+    def _flush(self):
+        # Move the uint16 partial sum into the full accumulator
+        if self.batch_count:
+            np.add(self.stack, self.batch, out=self.stack)
+            self.batch[:] = 0
+            self.batch_count = 0
+
+    def __getstate__(self):
+        # Pickle the flushed sum only (stack_video_frames_parallel)
+        self._flush()
+        state = self.__dict__.copy()
+        state["batch"] = None
+        return state
+
+    def merge(self, other):
+        if other.stack is None:
+            return self
+        other._flush()
+        if self.stack is None:
+            self.stack, self.count = other.stack, other.count
+        else:
+            self._flush()
+            self.stack += other.stack
+            self.count += other.count
+        return self
+
+    def result(self):
+        self._flush()
+        return np.uint8(np.clip(self.stack / self.count, 0, 255))
+
+class WeightedMeanReducer:
+    """
+    Weighted average of the stacked frames (vid_to_img_v3.py).
+
+    Parameters:
+    - weight_fn (callable): Weight of a frame from its position among the sampled frames.
+    - dtype: Accumulator type. With float64 the sum of the float32 weighted frames is exact
+      (up to about two million frames), so it does not depend on the order of the frames.
+    """
+
+    checkpoint_fields = ("weight_sum", "ranges")
+
+    def __init__(self, weight_fn, dtype=np.float32):
+        self.weight_fn = weight_fn
+        self.dtype = dtype
+        self.stack = None
+        self.scratch = None
+        self.weight_sum = 0.0
+        self.ranges = []  # [start, stop) runs of the stacked positions
+
+    def __getstate__(self):
+        # The scratch buffer is not part of the result, so don't pickle it
+        state = self.__dict__.copy()
+        state["scratch"] = None
+        return state
+
+    def add(self, frame, position):
+        if self.stack is None:
+            self.stack = np.zeros(frame.shape, dtype=self.dtype)
+        if self.scratch is None and self.stack.dtype != np.float32:
+            self.scratch = np.empty(frame.shape, dtype=np.float32)
+        weight = self.weight_fn(position)
+        if self.stack.dtype == np.float32:
+            # stack * 1 + frame * weight rounds exactly like the two numpy steps below
+            cv2.addWeighted(self.stack, 1.0, frame, float(np.float32(weight)), 0.0, dst=self.stack,
+                            dtype=cv2.CV_32F)
+        else:
+            np.multiply(frame, np.float32(weight), out=self.scratch, dtype=np.float32)
+            self.stack += self.scratch
+        self.weight_sum += weight
+        if self.ranges and self.ranges[-1][1] == position:
+            self.ranges[-1][1] += 1
+        else:
+            self.ranges.append([position, position + 1])
+
+    def merge(self, other):
+        if other.stack is None:
+            return self
+        if self.stack is None:
+            self.stack = other.stack
+        else:
+            self.stack += other.stack
+
+        # Sum the weights in frame order, as a single pass would
+        self.ranges = sorted(self.ranges + other.ranges)
+        self.weight_sum = 0.0
+        for start, stop in self.ranges:
+            for position in range(start, stop):
+                self.weight_sum += self.weight_fn(position)
+        return self
+
+    def result(self):
+        return np.uint8(np.clip(self.stack / self.weight_sum, 0, 255))
+
+class MaxReducer:
+    """Per-pixel maximum of the stacked frames (star trails, light painting)."""
+
+    checkpoint_fields = ()
+
+    def __init__(self):
+        self.stack = None
+
+    def add(self, frame, position):
+        if self.stack is None:
+            self.stack = frame.copy()
+        else:
+            np.maximum(self.stack, frame, out=self.stack)
+
+    def merge(self, other):
+        if other.stack is not None:
+            self.add(other.stack, None)
+        return self
+
+    def result(self):
+        return self.stack
+
+class MinReducer:
+    """Per-pixel minimum of the stacked frames."""
+
+    checkpoint_fields = ()
+
+    def __init__(self):
+        self.stack = None
+
+    def add(self, frame, position):
+        if self.stack is None:
+            self.stack = frame.copy()
+        else:
+            np.minimum(self.stack, frame, out=self.stack)
+
+    def merge(self, other):
+        if other.stack is not None:
+            self.add(other.stack, None)
+        return self
+
+    def result(self):
+        return self.stack
+
+class ExponentialDecayReducer:
+    """
+    Exponentially decaying average, so later frames count more than earlier ones.
+
+    Parameters:
+    - alpha (float): Weight of each new frame; older frames fade by (1 - alpha) per frame.
+    """
+
+    checkpoint_fields = ()
+
+    def __init__(self, alpha=0.1):
+        if not 0 < alpha <= 1:
+            raise ValueError("Decay alpha must be in (0, 1].")
+        self.alpha = alpha
+        self.stack = None
+
+    def add(self, frame, position):
+        if self.stack is None:
+            self.stack = frame.astype(np.float32)
+            return
+        cv2.accumulateWeighted(frame, self.stack, self.alpha)
+
+    def result(self):
+        return np.uint8(np.clip(self.stack, 0, 255))
+
+class MedianReducer:
+    """
+    Exact per-pixel median of uint8 frames from a 256-bin histogram per pixel and channel.
+
+    Memory does not depend on the number of frames but is 256 counters per pixel value,
+    so with tile_rows the frame is processed in bands of rows, one decoding pass per band.
+
+    Parameters:
+    - tile_rows (int): Rows per band, or None to histogram the whole frame in one pass.
+    """
+
+    def __init__(self, tile_rows=None):
+        self.tile_rows = tile_rows
+        self.median = None
+        self.band_start = 0
+        self.hist = None
+
+    def _start_band(self, frame_shape):
+        band_rows = min(self.tile_rows or frame_shape[0], frame_shape[0] - self.band_start)
+        band_size = band_rows * int(np.prod(frame_shape[1:]))
+        self.band_stop = self.band_start + band_rows
+        self.hist = np.zeros(band_size * 256, dtype=np.uint16)
+        self.offsets = np.arange(band_size, dtype=np.intp) * 256
+        self.indices = np.empty(band_size, dtype=np.intp)
+        self.count = 0
+
+    def add(self, frame, position):
+        if self.median is None:
+            self.median = np.zeros(frame.shape, dtype=np.uint8)
+        if self.hist is None:
+            self._start_band(frame.shape)
+        if self.count == np.iinfo(self.hist.dtype).max:
+            self.hist = self.hist.astype(np.uint32)
+
+        # Every pixel value lands in its own histogram, so the indices are unique
+        np.add(self.offsets, frame[self.band_start:self.band_stop].ravel(), out=self.indices)
+        self.hist[self.indices] += 1
+        self.count += 1
+
+    def finish_pass(self):
+        """Turn the histograms of the current band into medians; return True if another band remains."""
+        if self.hist is None:
+            return False
+        hist = self.hist.reshape(-1, 256)
+        band = self.median[self.band_start:self.band_stop].reshape(-1)
+        low_rank, high_rank = (self.count - 1) // 2, self.count // 2
+        for start in range(0, len(hist), 65536):
+            cumulative = np.cumsum(hist[start:start + 65536], axis=1, dtype=np.uint32)
+            low = (cumulative > low_rank).argmax(axis=1)
+            high = (cumulative > high_rank).argmax(axis=1)
+            band[start:start + 65536] = (low + high) // 2
+        self.hist = None
+        self.band_start = self.band_stop
+        return self.band_start < self.median.shape[0]
+
+    def result(self):
+        return self.median
+
+class SigmaClipReducer:
+    """
+    Per-pixel sigma-clipped mean: values further than sigma standard deviations from the
+    mean are left out, so satellites, birds and glints don't smear into the stack.
+
+    The first decoding pass collects the mean and standard deviation, and each of the
+    iterations passes averages the values inside the clip bounds (and refines them).
+
+    Parameters:
+    - sigma (float): Clip bound in standard deviations.
+    - iterations (int): Number of clipping passes.
+    """
+
+    def __init__(self, sigma=3.0, iterations=1):
+        if iterations < 1:
+            raise ValueError("Sigma clipping needs at least one clipping pass.")
+        self.sigma = sigma
+        self.iterations = iterations
+        self.pass_index = 0
+        self.total = None
+
+    def add(self, frame, position):
+        if self.total is None:
+            self.total = np.zeros(frame.shape, dtype=np.float64)
+            self.total_sq = np.zeros(frame.shape, dtype=np.float64)
+            self.count = np.zeros(frame.shape, dtype=np.uint32)
+            self.inside = np.empty(frame.shape, dtype=bool)
+            self.below = np.empty(frame.shape, dtype=bool)
+            self.scratch = np.empty(frame.shape, dtype=np.float64)
+
+        if self.pass_index == 0:
+            self.inside[:] = True
+        else:
+            np.greater_equal(frame, self.low, out=self.inside)
+            np.less_equal(frame, self.high, out=self.below)
+            self.inside &= self.below
+        np.add(self.total, frame, out=self.total, where=self.inside)
+        np.square(frame, out=self.scratch, dtype=np.float64)
+        np.add(self.total_sq, self.scratch, out=self.total_sq, where=self.inside)
+        self.count += self.inside
+
+    def _statistics(self):
+        count = np.maximum(self.count, 1)
+        mean = self.total / count
+        std = np.sqrt(np.maximum(self.total_sq / count - mean * mean, 0))
+        return mean, std
+
+    def finish_pass(self):
+        """Update the clip bounds from this pass; return True if another pass is needed."""
+        if self.total is None:
+            return False
+        mean, std = self._statistics()
+        if self.pass_index > 0:
+            # Pixels with every value clipped keep their previous mean
+            mean = np.where(self.count > 0, mean, self.mean)
+        self.mean = mean
+        if self.pass_index == self.iterations:
+            return False
+
+        self.low = mean - self.sigma * std
+        self.high = mean + self.sigma * std
+        self.total[:] = 0
+        self.total_sq[:] = 0
+        self.count[:] = 0
+        self.pass_index += 1
+        return True
+
+    def result(self):
+        return np.uint8(np.clip(self.mean, 0, 255))
+
+class SlidingMeanReducer:
+    """
+    Mean of the last window frames, for running-average videos (see stack_video_sliding).
+
+    The last frames are kept in a ring buffer next to their integer sum: each new frame is
+    added to the sum and the frame it replaces in the ring is subtracted, so the cost per
+    frame doesn't depend on the window size.
+
+    Parameters:
+    - window (int): Number of frames averaged.
+    """
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError("The window must hold at least one frame.")
+        self.window = window
+        self.ring = None
+        self.count = 0
+
+    def add(self, frame, position):
+        if self.ring is None:
+            self.ring = np.empty((self.window,) + frame.shape, dtype=np.uint8)
+            self.stack = np.zeros(frame.shape, dtype=np.int32)
+            self.mean = np.empty(frame.shape, dtype=np.int32)
+            self.image = np.empty(frame.shape, dtype=np.uint8)
+        slot = self.ring[self.count % self.window]
+        if self.count >= self.window:
+            np.subtract(self.stack, slot, out=self.stack)
+        np.add(self.stack, frame, out=self.stack)
+        slot[:] = frame
+        self.count += 1
+
+    def result(self):
+        # Truncate like the uint8 conversion of the other mean reducers
+        np.floor_divide(self.stack, min(self.count, self.window), out=self.mean)
+        self.image[:] = self.mean
+        return self.image
+
+def make_reducer(reducer, max_frame_count=None, decay_alpha=0.1, accumulate_dtype=np.float32, tile_rows=None,
+                 clip_sigma=3.0):
+    """
+    Create a reducer from its name, or return a reducer object unchanged.
+
+    Names: "mean", "weighted" (opacity weights of calculate_opacity_weight), "max", "min",
+    "decay" (exponential decay with decay_alpha), "median" (in bands of tile_rows) and
+    "sigma_clip" (mean clipped at clip_sigma standard deviations).
+    """
+    if not isinstance(reducer, str):
+        return reducer
+    if reducer == "mean":
+        # Integer sums are exact, so the mean never needs a float accumulator
+        return MeanReducer()
+    if reducer == "weighted":
+        return WeightedMeanReducer(partial(calculate_opacity_weight, total_frames=max_frame_count), accumulate_dtype)
+    if reducer == "max":
+        return MaxReducer()
+    if reducer == "min":
+        return MinReducer()
+    if reducer == "decay":
+        return ExponentialDecayReducer(decay_alpha)
+    if reducer == "median":
+        return MedianReducer(tile_rows)
+    if reducer == "sigma_clip":
+        return SigmaClipReducer(clip_sigma)
+    raise ValueError(f"Unknown reducer '{reducer}'.")
+
+def iter_sampled_frames(cap, frame_interval=1, max_frame_count=None, skip_first_frame=False, seek=False,
+                        start_frame=0):
+    """
+    Yield every frame_interval-th frame, decoding as little of the skipped frames as possible.
+
+    Skipped frames are only grabbed (cap.grab() without cap.retrieve()), so they skip the
+    color conversion and copy. With seek=True the capture jumps straight to each sampled
+    frame instead, which also skips decoding when the frame interval is longer than the
+    keyframe distance. This relies on frame-accurate seeking of the backend (FFmpeg).
+    start_frame seeks to that frame first and yields frames from there up to max_frame_count.
+
+    Yields:
+    - (frame_index, position, frame): Index of the frame in the video, its position among
+      the sampled frames (0 for the first frame) and the decoded frame.
+    """
+    position = -(-start_frame // frame_interval)  # First sampled frame at or after start_frame
+    if skip_first_frame:
+        position = max(position, 1)
+    if start_frame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    if seek and frame_interval > 1:
+        while max_frame_count is None or position * frame_interval < max_frame_count:
+            frame_index = position * frame_interval
+            if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frame_index:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            ret, frame = cap.read()
+            if not ret:
+                break  # Break if no more frames are available
+            yield frame_index, position, frame
+            position += 1
+        return
+
+    frame_index = start_frame
+    while max_frame_count is None or frame_index < max_frame_count:
+        if not cap.grab():
+            break  # Break if no more frames are available
+
+        if frame_index == position * frame_interval:
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            yield frame_index, position, frame
+            position += 1
+        frame_index += 1
+
+def get_output_size(frame_width, frame_height, roi=None, scale=None):
+    """
+    Size of the frames after cropping to roi and scaling by scale.
+
+    Parameters:
+    - roi (tuple): (x, y, width, height) of the region to keep, in source pixels.
+    - scale (float): Scale factor applied after cropping, e.g. 0.25 for a quarter-size preview.
+
+    Returns:
+    - (width, height): Size of the prepared frames.
+    """
+    if roi is not None:
+        x, y, width, height = roi
+        if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > frame_width or y + height > frame_height:
+            raise ValueError(f"ROI {roi} is not inside the {frame_width}x{frame_height} frame.")
+        frame_width, frame_height = width, height
+    if scale is not None:
+        if scale <= 0:
+            raise ValueError("Scale must be a positive value.")
+        frame_width, frame_height = max(1, round(frame_width * scale)), max(1, round(frame_height * scale))
+    return frame_width, frame_height
+
+def iter_prepared_frames(frames, roi=None, output_size=None):
+    """
+    Crop and resize the frames of iter_sampled_frames before they are accumulated, so the
+    reducers only allocate and touch the output size. The crop is a view of the decoded
+    frame; downscaling uses INTER_AREA.
+    """
+    for frame_index, position, frame in frames:
+        if roi is not None:
+            x, y, width, height = roi
+            frame = frame[y:y + height, x:x + width]
+        if output_size is not None and output_size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, output_size, interpolation=cv2.INTER_AREA)
+        yield frame_index, position, frame
+
+def iter_frames_threaded(frames, queue_depth=8):
+    """
+    Run a frame iterator on a decoder thread and hand its items over through a bounded queue.
+
+    OpenCV releases the GIL while decoding, so decoding the next frames overlaps with
+    accumulating the current one. The decoder blocks once queue_depth frames are
+    waiting, which bounds the memory held by decoded frames.
+
+    Parameters:
+    - frames (iterator): Frame iterator, e.g. from iter_sampled_frames.
+    - queue_depth (int): Maximum number of decoded frames waiting to be accumulated.
+    """
+    if queue_depth < 1:
+        raise ValueError("Queue depth must be at least 1.")
+    frame_queue = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Block while the queue is full, but give up when the consumer has stopped
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode():
+        try:
+            for item in frames:
+                if not put(item):
+                    return
+            put(finished)
+        except Exception as error:
+            put(error)
+
+    decoder = threading.Thread(target=decode, name="frame-decoder", daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        decoder.join()
+
+def save_checkpoint(checkpoint_path, reducer, manifest):
+    """
+    Save the accumulator of a reducer to a memory-mapped .npy and its state to a JSON file.
+
+    The accumulator goes to a new <checkpoint_path>.<generation>.npy, and the JSON file
+    <checkpoint_path>.json is only switched to it (atomically) once the array is on disk,
+    so a crash at any point leaves the previous checkpoint intact.
+
+    Parameters:
+    - checkpoint_path (str): Path of the checkpoint without extension.
+    - reducer (object): Reducer with a stack array and checkpoint_fields.
+    - manifest (dict): Settings and per-video progress to store with the accumulator.
+
+    Returns:
+    - manifest (dict): The stored manifest, including the new generation.
+    """
+    if hasattr(reducer, "_flush"):
+        reducer._flush()
+    generation = manifest.get("generation", 0) + 1
+    array_path = f"{checkpoint_path}.{generation}.npy"
+    stack = np.lib.format.open_memmap(array_path, mode="w+", dtype=reducer.stack.dtype, shape=reducer.stack.shape)
+    stack[:] = reducer.stack
+    stack.flush()
+    del stack
+
+    manifest = dict(manifest, generation=generation, array=os.path.basename(array_path),
+                    fields={name: getattr(reducer, name) for name in reducer.checkpoint_fields})
+    temp_path = checkpoint_path + ".json.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, checkpoint_path + ".json")
+
+    # The previous generation is no longer referenced
+    previous_path = f"{checkpoint_path}.{generation - 1}.npy"
+    if os.path.exists(previous_path):
+        os.remove(previous_path)
+    return manifest
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load a checkpoint written by save_checkpoint.
+
+    Returns:
+    - (stack, manifest): The accumulator and the manifest, or (None, None) if there is no checkpoint.
+    """
+    json_path = checkpoint_path + ".json"
+    if not os.path.exists(json_path):
+        return None, None
+    with open(json_path) as f:
+        manifest = json.load(f)
+    array_path = os.path.join(os.path.dirname(checkpoint_path), manifest["array"])
+    return np.array(np.load(array_path, mmap_mode="r")), manifest
+
+def _open_checkpoint(checkpoint_path, reducer, settings, video_path, frame_shape):
+    """Restore the reducer from the checkpoint and return the manifest and the entry of this video."""
+    if not hasattr(reducer, "checkpoint_fields"):
+        raise ValueError(f"The {type(reducer).__name__} reducer can't be checkpointed.")
+
+    stack, manifest = load_checkpoint(checkpoint_path)
+    if manifest is None:
+        manifest = {"settings": settings, "videos": []}
+    else:
+        if manifest["settings"] != settings:
+            raise ValueError(f"Checkpoint '{checkpoint_path}' was made with other settings: {manifest['settings']}")
+        if stack.shape[:2] != frame_shape:
+            raise ValueError(f"Checkpoint '{checkpoint_path}' stacks {stack.shape[1]}x{stack.shape[0]} frames.")
+        reducer.stack = stack
+        for name, value in manifest["fields"].items():
+            setattr(reducer, name, value)
+
+    # Find this video among the stacked ones, or add it
+    info = os.stat(video_path)
+    path = os.path.abspath(video_path)
+    for entry in manifest["videos"]:
+        if entry["path"] == path:
+            if (entry["size"], entry["mtime"]) != (info.st_size, info.st_mtime):
+                raise ValueError(f"'{video_path}' changed since it was stacked into '{checkpoint_path}'.")
+            return manifest, entry
+    entry = {"path": path, "size": info.st_size, "mtime": info.st_mtime, "next_frame": 0, "stacked_frames": 0,
+             "complete": False}
+    manifest["videos"].append(entry)
+    return manifest, entry
+
+def stack_video_frames(video_path, output_image_path, target_fps=None, duration=None, reducer="mean",
+                       skip_first_frame=False, decay_alpha=0.1, seek=False, threaded=False, queue_depth=8,
+                       progress_every=1, accumulate_dtype=np.float32, tile_rows=None, clip_sigma=3.0,
+                       checkpoint_path=None, checkpoint_every=500, roi=None, scale=None):
+    """
+    Stack the frames of a video into a single image in one decoding pass.
+
+    The earlier scripts are configurations of this one:
+    - vid_to_img.py:    stack_video_frames(video_path, output_image_path)
+    - vid_to_img_v2.py: stack_video_frames(video_path, output_image_path, target_fps=2, duration=10)
+    - vid_to_img_v3.py: stack_video_frames(video_path, output_image_path, target_fps=60, duration=13,
+                                           reducer="weighted", skip_first_frame=True)
+
+    Parameters:
+    - video_path (str): Path to the input video.
+    - output_image_path (str): Path to save the stacked image.
+    - target_fps (float): Take frames at this rate instead of every frame.
+    - duration (float): Only stack the first duration seconds.
+    - reducer (str or object): "mean", "weighted", "max", "min", "decay", "median",
+      "sigma_clip", or an object with add(frame, position) and result() methods. A reducer
+      whose finish_pass() returns True gets the frames again in another decoding pass.
+    - skip_first_frame (bool): Leave out the first frame but keep counting it for the
+      opacity weights, as vid_to_img_v3.py does.
+    - decay_alpha (float): Weight of each new frame for the "decay" reducer.
+    - seek (bool): Seek to each sampled frame instead of grabbing through the skipped ones
+      (see iter_sampled_frames). Faster when target_fps is far below the video FPS.
+    - threaded (bool): Decode on a separate thread while frames are accumulated (see
+      iter_frames_threaded).
+    - queue_depth (int): Maximum number of decoded frames waiting when threaded.
+    - progress_every (int): Print progress every this many stacked frames (0 for none).
+    - accumulate_dtype: Accumulator type of the "weighted" reducer ("mean" always sums in
+      uint32). np.float64 gives the exact, order-independent sums used by stack_video_frames_parallel.
+    - tile_rows (int): Rows per band for the "median" reducer, to bound its memory.
+    - clip_sigma (float): Clip bound in standard deviations for the "sigma_clip" reducer.
+    - checkpoint_path (str): Save the accumulator here (see save_checkpoint) every
+      checkpoint_every frames and at the end. An interrupted run with the same checkpoint
+      resumes after the last saved frame, and a video that isn't in the checkpoint yet is
+      stacked onto the videos already in it. Not for the multi-pass reducers.
+    - checkpoint_every (int): Stacked frames between checkpoints.
+    - roi (tuple): Only stack this (x, y, width, height) region of the frames.
+    - scale (float): Scale the (cropped) frames by this factor before stacking.
+
+    Returns:
+    - stacked_image (ndarray): The stacked image, or None if nothing could be stacked.
+    """
+    # Check if the file exists
+    if not os.path.exists(video_path):
+        print(f"Error: File '{video_path}' not found.")
+        return
+
+    # Open the video file
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Unable to open video file '{video_path}'")
+        return
+
+    # Get video properties
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    print(f"Video Properties - Width: {frame_width}, Height: {frame_height}, Total Frames: {total_frames}, FPS: {video_fps}")
+
+    # Determine frame interval based on the desired FPS
+    frame_interval = 1  # Default: Take every frame
+    if target_fps and target_fps < video_fps:
+        frame_interval = set_fps_interval(video_fps, target_fps)
+        print(f"Target FPS: {target_fps}. Taking 1 frame every {frame_interval} frames.")
+
+    # Determine the maximum number of frames to process based on the desired duration
+    max_frame_count = total_frames if total_frames > 0 else None  # Default: Use the whole video
+    if duration:
+        max_frame_count = set_video_duration(total_frames, video_fps, duration)
+        print(f"Target Duration: {duration} seconds. Processing up to frame {max_frame_count}.")
+
+    # Determine the size of the stacked image
+    output_size = get_output_size(frame_width, frame_height, roi, scale)
+    if output_size != (frame_width, frame_height):
+        print(f"Stacking {output_size[0]}x{output_size[1]} frames (ROI: {roi}, scale: {scale}).")
+
+    settings = {"reducer": reducer if isinstance(reducer, str) else type(reducer).__name__, "target_fps": target_fps,
+                "duration": duration, "skip_first_frame": skip_first_frame, "decay_alpha": decay_alpha,
+                "roi": list(roi) if roi is not None else None, "scale": scale}
+    reducer = make_reducer(reducer, max_frame_count, decay_alpha, accumulate_dtype, tile_rows, clip_sigma)
+
+    # Pick up the stack (and the progress on this video) from the checkpoint
+    start_frame = 0
+    if checkpoint_path:
+        manifest, entry = _open_checkpoint(checkpoint_path, reducer, settings, video_path, output_size[::-1])
+        start_frame = entry["next_frame"]
+        if entry["complete"]:
+            print(f"'{video_path}' is already stacked in '{checkpoint_path}'.")
+        elif start_frame:
+            print(f"Resuming from frame {start_frame} of checkpoint '{checkpoint_path}'.")
+
+    while True:
+        processed_frames = 0  # Frames that have been stacked
+        if checkpoint_path and entry["complete"]:
+            break
+
+        # Accumulate the sampled frames, optionally decoding on a separate thread
+        frames = iter_sampled_frames(cap, frame_interval, max_frame_count, skip_first_frame, seek, start_frame)
+        if roi is not None or scale is not None:
+            frames = iter_prepared_frames(frames, roi, output_size)
+        if threaded:
+            frames = iter_frames_threaded(frames, queue_depth)
+
+        for frame_index, position, frame in frames:
+            reducer.add(frame, position)
+            processed_frames += 1
+            if progress_every and processed_frames % progress_every == 0:
+                print(f"Stacking frame {frame_index}/{max_frame_count or total_frames}...")
+            if checkpoint_path:
+                entry["next_frame"] = frame_index + 1
+                entry["stacked_frames"] += 1
+                if processed_frames % checkpoint_every == 0:
+                    manifest = save_checkpoint(checkpoint_path, reducer, manifest)
+
+        if checkpoint_path:
+            entry["complete"] = True
+            if processed_frames:
+                manifest = save_checkpoint(checkpoint_path, reducer, manifest)
+            break
+
+        # Multi-pass reducers get the video again from the start
+        if processed_frames == 0 or not (hasattr(reducer, "finish_pass") and reducer.finish_pass()):
+            break
+        print("Starting another pass over the video...")
+        cap.release()
+        cap = cv2.VideoCapture(video_path)
+
+    # Release video capture
+    cap.release()
+
+    if checkpoint_path:
+        processed_frames = sum(video["stacked_frames"] for video in manifest["videos"])
+    if processed_frames == 0:
+        print(f"Error: Unable to read any frames to stack from '{video_path}'")
+        return
+
+    # Save the stacked image
+    stacked_image = reducer.result()
+    cv2.imwrite(output_image_path, stacked_image)
+    print(f"Saved the stacked image as '{output_image_path}' after stacking {processed_frames} frames.")
+    return stacked_image
+
+def _stack_segment(video_path, start_frame, stop_frame, frame_interval, reducer, max_frame_count, skip_first_frame,
+                   roi=None, output_size=None):
+    """Stack the sampled frames in [start_frame, stop_frame) of the video and return the reducer."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Error: Unable to open video file '{video_path}'")
+    try:
+        reducer = make_reducer(reducer, max_frame_count, accumulate_dtype=np.float64)
+        frames = iter_sampled_frames(cap, frame_interval, stop_frame, skip_first_frame, start_frame=start_frame)
+        for frame_index, position, frame in iter_prepared_frames(frames, roi, output_size):
+            reducer.add(frame, position)
+        return reducer
+    finally:
+        cap.release()
+
+def stack_video_frames_parallel(video_path, output_image_path, target_fps=None, duration=None, reducer="mean",
+                                skip_first_frame=False, workers=None, segments_per_worker=2, roi=None, scale=None):
+    """
+    Stack a video on several processes, each stacking one time segment, and merge the results.
+
+    Each worker opens the video, seeks to the start of its segment and returns its
+    reducer; the segments are merged in the parent. "mean" sums in uint32 and "weighted"
+    in float64, where the sums are exact, so the result is bit-for-bit the same as
+    stack_video_frames(..., accumulate_dtype=np.float64). "max" and "min" merge exactly.
+
+    Parameters:
+    - video_path, output_image_path, target_fps, duration, skip_first_frame, roi, scale: As in
+      stack_video_frames.
+    - reducer (str): "mean", "weighted", "max" or "min".
+    - workers (int): Number of worker processes. Defaults to the number of CPUs.
+    - segments_per_worker (int): Segments per worker, for load balancing.
+
+    Returns:
+    - stacked_image (ndarray): The stacked image, or None if nothing could be stacked.
+    """
+    if reducer not in ("mean", "weighted", "max", "min"):
+        raise ValueError(f"Reducer '{reducer}' cannot be stacked in parallel segments.")
+
+    # Check if the file exists
+    if not os.path.exists(video_path):
+        print(f"Error: File '{video_path}' not found.")
+        return
+
+    # Get video properties
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Unable to open video file '{video_path}'")
+        return
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    output_size = get_output_size(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                  roi, scale)
+    cap.release()
+    if total_frames <= 0:
+        raise ValueError("Parallel stacking needs the frame count of the video; use stack_video_frames.")
+
+    frame_interval = 1
+    if target_fps and target_fps < video_fps:
+        frame_interval = set_fps_interval(video_fps, target_fps)
+    max_frame_count = total_frames
+    if duration:
+        max_frame_count = set_video_duration(total_frames, video_fps, duration)
+
+    # Split the sampled frames into segments that start on a sampled frame
+    workers = workers or os.cpu_count()
+    sample_count = -(-max_frame_count // frame_interval)
+    if sample_count <= 0:
+        print(f"Error: Unable to read any frames to stack from '{video_path}'")
+        return
+    segment_count = max(1, min(sample_count, workers * segments_per_worker))
+    bounds = [int(round(i * sample_count / segment_count)) * frame_interval for i in range(segment_count + 1)]
+    bounds[-1] = max_frame_count
+    print(f"Stacking {sample_count} frames of '{video_path}' in {segment_count} segments on {workers} processes")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_stack_segment, video_path, start, stop, frame_interval, reducer,
+                                   max_frame_count, skip_first_frame, roi, output_size)
+                   for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        merged = futures[0].result()
+        for future in futures[1:]:
+            merged.merge(future.result())
+
+    if merged.stack is None:
+        print(f"Error: Unable to read any frames to stack from '{video_path}'")
+        return
+
+    # Save the stacked image
+    stacked_image = merged.result()
+    cv2.imwrite(output_image_path, stacked_image)
+    print(f"Saved the stacked image as '{output_image_path}'")
+    return stacked_image
+
+def stack_video_sliding(video_path, output_video_path, window=30, target_fps=None, duration=None, stride=1,
+                        seek=False, threaded=False, queue_depth=8, codec="mp4v", progress_every=100, roi=None,
+                        scale=None):
+    """
+    Write a video of running averages: each output frame is the mean of the last window
+    sampled frames (fewer at the start), kept up to date in O(1) per frame by SlidingMeanReducer.
+
+    Parameters:
+    - video_path (str): Path to the input video.
+    - output_video_path (str): Path to save the averaged video.
+    - window (int): Number of sampled frames in each average.
+    - target_fps, duration, seek, threaded, queue_depth, roi, scale: As in stack_video_frames.
+    - stride (int): Write every stride-th average, to speed up the output as a time-lapse.
+    - codec (str): FourCC of the output video.
+    - progress_every (int): Print progress every this many sampled frames (0 for none).
+
+    Returns:
+    - written_frames (int): Number of frames written, or None if the video can't be read.
+    """
+    # Check if the file exists
+    if not os.path.exists(video_path):
+        print(f"Error: File '{video_path}' not found.")
+        return
+
+    # Open the video file
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Error: Unable to open video file '{video_path}'")
+        return
+
+    # Get video properties
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    print(f"Video Properties - Width: {frame_width}, Height: {frame_height}, Total Frames: {total_frames}, FPS: {video_fps}")
+
+    frame_interval = 1
+    if target_fps and target_fps < video_fps:
+        frame_interval = set_fps_interval(video_fps, target_fps)
+    max_frame_count = set_video_duration(total_frames, video_fps, duration) if duration else None
+    output_size = get_output_size(frame_width, frame_height, roi, scale)
+
+    # The output plays the sampled frames at their own rate, sped up by the stride
+    writer = None
+    reducer = SlidingMeanReducer(window)
+    frames = iter_sampled_frames(cap, frame_interval, max_frame_count, seek=seek)
+    if roi is not None or scale is not None:
+        frames = iter_prepared_frames(frames, roi, output_size)
+    if threaded:
+        frames = iter_frames_threaded(frames, queue_depth)
+
+    written_frames = 0
+    try:
+        for frame_index, position, frame in frames:
+            reducer.add(frame, position)
+            if position % stride == 0:
+                if writer is None:
+                    writer = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*codec),
+                                             video_fps / frame_interval, output_size)
+                    if not writer.isOpened():
+                        raise IOError(f"Error: Unable to open video writer for '{output_video_path}'")
+                writer.write(reducer.result())
+                written_frames += 1
+            if progress_every and (position + 1) % progress_every == 0:
+                print(f"Averaging frame {frame_index}/{max_frame_count or total_frames}...")
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+
+    print(f"Saved the running average of {window} frames as '{output_video_path}' ({written_frames} frames).")
+    return written_frames
+
+# Example usage with target FPS and duration control
+if __name__ == "__main__":
+    stack_video_frames('Image_analysis/input_video.mp4', 'stacked_output_image.jpg', target_fps=2, duration=10)
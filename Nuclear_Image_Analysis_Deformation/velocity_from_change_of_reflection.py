@@ -1,23 +1,35 @@
 import cv2
+import glob
+import hashlib
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from matplotlib.figure import Figure
 
-# Function to find the bright ribbon area in each frame
-def find_bright_ribbon_area(frame):
-    # Convert the frame to the HSV color space
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+# Per-frame metrics returned by process_video, in order
+METRIC_COLUMNS = ("time", "area", "cog_x", "cog_y", "com_x", "com_y")
 
-    # Focus on the Value channel (brightness) to detect bright areas
-    _, _, v = cv2.split(hsv)
-    
-    # Threshold the Value channel to get bright regions
-    _, thresh = cv2.threshold(v, 200, 255, cv2.THRESH_BINARY)  # Adjust threshold as needed
-    
+# Function to get the binary mask of the bright regions in a frame
+def find_bright_mask(frame, threshold=200):
+    # Threshold the brightness (the HSV Value channel, max(B, G, R)) to get bright regions.
+    # A pixel is bright unless all of its channels are at or below the threshold, which
+    # gives the same mask as cv2.threshold on the Value channel without the HSV conversion.
+    thresh = cv2.bitwise_not(cv2.inRange(frame, (0, 0, 0), (threshold, threshold, threshold)))
+    return clean_bright_mask(thresh)
+
+# Function to clean up the thresholded mask
+def clean_bright_mask(thresh):
     # Apply morphological operations to clean up the noise and better detect the ribbon
     kernel = np.ones((5, 5), np.uint8)
     thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)  # Closing to fill small gaps
     thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)   # Opening to remove small noise
+    return thresh
+
+# Function to find the bright ribbon area in each frame
+def find_bright_ribbon_area(frame, threshold=200):
+    thresh = find_bright_mask(frame, threshold)
 
     # Find contours of the bright regions
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -31,22 +43,181 @@ def find_bright_ribbon_area(frame):
 
     return marked_frame, total_area
 
+# Function to measure the area, center of gravity and center of mass of the bright ribbon
+def measure_bright_ribbon(frame, threshold=200, method="moments", draw=False):
+    """
+    Measure the bright ribbon in a frame, as ribbon_area_deformation.ipynb does.
+
+    COG is the centroid of the largest bright region and COM the area-weighted mean of the
+    centroids of all regions (the centroid of all bright pixels), both in whole pixels.
+
+    method="contours" measures every contour with cv2.contourArea and cv2.moments, like
+    find_bright_ribbon_area. method="moments" gets the pixel count and centroid of every
+    region from one cv2.connectedComponentsWithStats call on the mask, without extracting
+    contours, and doesn't loop over the regions in Python.
+
+    The two methods measure different things, so "moments" only approximates "contours".
+    Its area is the number of bright pixels, while contourArea is the area of the polygon
+    through the boundary pixel centres, about half a perimeter smaller. Its centroids
+    weight every bright pixel, while the polygon centroid barely counts thin parts (a
+    one-pixel-wide line encloses almost no polygon area). On compact blobs, e.g. the
+    pendulum clip at threshold 200, the area is 2-3% larger and COG and COM agree within a
+    pixel or two. On thin or fragmented regions they diverge: at threshold 50, where the
+    pendulum string and up to 82 specks pass the threshold, the area differed by up to 12%,
+    the COG by up to 16 px and the COM by up to 24 px. Use "contours" (the default of
+    process_video) for such masks or when the results have to match the notebook.
+
+    Parameters:
+    - frame (ndarray): BGR frame.
+    - threshold (int): Brightness (HSV value) threshold.
+    - method (str): "moments" or "contours".
+    - draw (bool): Return a copy of the frame with the ribbon outlined in green. Only
+      needed for frames that are saved.
+
+    Returns:
+    - (marked_frame, area, cog, com): marked_frame is None unless draw is set.
+    """
+    thresh = find_bright_mask(frame, threshold)
+    total_area, cog, com = measure_mask(thresh, method)
+
+    marked_frame = mark_bright_ribbon(frame, thresh) if draw else None
+    return marked_frame, total_area, cog, com
+
+# Function to measure the area, COG and COM of the regions in a cleaned mask
+def measure_mask(thresh, method="moments", offset=(0, 0)):
+    """
+    The measurements of measure_bright_ribbon on a mask. offset is the (x, y) position of
+    the mask in the frame, for masks of a region of interest.
+
+    Returns:
+    - (area, cog, com)
+    """
+    cog, com = (0, 0), (0, 0)
+
+    if method == "contours":
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        region_areas = [cv2.contourArea(c) for c in contours]
+        total_area = sum(region_areas)
+        if contours:
+            # COG is the centroid of the largest contour
+            M = cv2.moments(contours[int(np.argmax(region_areas))])
+            if M["m00"] != 0:
+                cog = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+
+            # COM is the area-weighted average of the contour centroids
+            com_x, com_y, total_weight = 0, 0, 0
+            for contour, area in zip(contours, region_areas):
+                M = cv2.moments(contour)
+                if M["m00"] != 0:
+                    com_x += int(M["m10"] / M["m00"]) * area
+                    com_y += int(M["m01"] / M["m00"]) * area
+                    total_weight += area
+            if total_weight != 0:
+                com = (int(com_x / total_weight), int(com_y / total_weight))
+    elif method == "moments":
+        # Label the regions inside the bounding box of the bright pixels; label 0 is the background
+        x, y, width, height = cv2.boundingRect(thresh)
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(thresh[y:y + height, x:x + width],
+                                                                      connectivity=8)
+        region_areas = stats[1:, cv2.CC_STAT_AREA]
+        total_area = int(region_areas.sum())
+        if count > 1:
+            cog_x, cog_y = centroids[1 + np.argmax(region_areas)]
+            com_x, com_y = region_areas @ centroids[1:] / total_area
+            x, y = x + offset[0], y + offset[1]
+            cog, com = (int(cog_x + x), int(cog_y + y)), (int(com_x + x), int(com_y + y))
+    else:
+        raise ValueError(f"Unknown method '{method}'.")
+
+    return total_area, cog, com
+
+# Function to outline the bright ribbon in green on a copy of the frame
+def mark_bright_ribbon(frame, thresh):
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    marked_frame = frame.copy()
+    cv2.drawContours(marked_frame, contours, -1, (0, 255, 0), 2)  # Mark the ribbon in green
+    return marked_frame
+
+# Function to measure the ribbon inside a region of interest around its last position
+def track_bright_ribbon(frame, roi, threshold=200, method="moments", edge=8):
+    """
+    Measure the bright ribbon only inside roi, e.g. its bounding box in the previous frame
+    plus a margin.
+
+    The mask inside the ROI is the same as in the full frame as long as no bright pixel is
+    within edge pixels of an ROI side (the morphology reaches 8 pixels), so when the ribbon
+    is lost or comes that close to a side that isn't the frame edge, this returns None and
+    the frame has to be scanned in full. Bright regions outside the ROI are not seen.
+
+    Parameters:
+    - frame (ndarray): BGR frame.
+    - roi (tuple): (x, y, width, height) to search.
+    - threshold (int), method (str): As in measure_bright_ribbon.
+    - edge (int): Distance from the ROI sides that makes the ROI unreliable.
+
+    Returns:
+    - (area, cog, com, bbox): The measurements and the bounding box of the ribbon, or None.
+    """
+    x, y, width, height = roi
+    frame_height, frame_width = frame.shape[:2]
+    thresh = cv2.bitwise_not(cv2.inRange(frame[y:y + height, x:x + width], (0, 0, 0),
+                                         (threshold, threshold, threshold)))
+
+    # Check that the bright pixels stay clear of the ROI sides
+    bx, by, bw, bh = cv2.boundingRect(thresh)
+    if bw == 0:
+        return None  # Lost
+    if ((x > 0 and bx < edge) or (y > 0 and by < edge) or (x + width < frame_width and bx + bw > width - edge)
+            or (y + height < frame_height and by + bh > height - edge)):
+        return None  # Touching the ROI edge
+
+    thresh = clean_bright_mask(thresh)
+    area, cog, com = measure_mask(thresh, method, (x, y))
+    if area == 0:
+        return None
+    bx, by, bw, bh = cv2.boundingRect(thresh)
+    return area, cog, com, (bx + x, by + y, bw, bh)
+
+# Function to expand a bounding box by a margin, within the frame
+def expand_roi(bbox, margin, frame_shape):
+    x, y, width, height = bbox
+    x0, y0 = min(max(0, x - margin), frame_shape[1] - 1), min(max(0, y - margin), frame_shape[0] - 1)
+    x1, y1 = max(min(frame_shape[1], x + width + margin), x0 + 1), max(min(frame_shape[0], y + height + margin), y0 + 1)
+    return x0, y0, x1 - x0, y1 - y0
+
 # Function to process the video and analyze the ribbon area
-def process_video(video_path, output_folder):
+def process_video(video_path, output_folder, method="contours", threshold=200, track=False, margin=32,
+                  full_scan_every=0):
+    """
+    Measure the bright ribbon in every frame of a video and save one marked frame per second.
+
+    With track=True only the ribbon's bounding box in the previous frame, moved on by its
+    last displacement, plus margin pixels is processed (see track_bright_ribbon). The full
+    frame is scanned when the ribbon is lost or reaches the side of that region, on saved
+    frames, and every full_scan_every frames (0 for never) to pick up new bright regions.
+
+    The measurements go into NumPy columns preallocated for the frame count of the video.
+
+    Returns:
+    - (metrics, fps): Dict of the columns in METRIC_COLUMNS (one row per frame) and the FPS.
+    """
     # Open the video
     cap = cv2.VideoCapture(video_path)
 
     if not cap.isOpened():
         print("Error opening video file")
-        return [], [], 0
+        return {name: np.empty(0) for name in METRIC_COLUMNS}, 0
 
     fps = cap.get(cv2.CAP_PROP_FPS)  # Frames per second
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     dt = 1 / fps  # Time difference between frames
 
-    areas = []
-    times = []
+    # Columns of per-frame metrics, grown if the frame count was too low
+    rows = np.zeros((max(frame_count, 1), len(METRIC_COLUMNS)))
     frame_idx = 0
+    roi = None  # Region to search in the next frame when tracking
+    last_bbox = None  # Bounding box of the ribbon in the previous frame
+    full_scans = 0
     
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
@@ -57,31 +228,106 @@ def process_video(video_path, output_folder):
         if not ret:
             break  # End of video
 
-        # Find the ribbon area in the current frame
-        marked_frame, area = find_bright_ribbon_area(frame)
+        # Find the ribbon area in the current frame, around its last position if tracking
+        save_frame = frame_idx % int(fps) == 0  # Save one frame per second
+        result = None
+        if roi is not None and not save_frame and not (full_scan_every and frame_idx % full_scan_every == 0):
+            result = track_bright_ribbon(frame, roi, threshold, method)
+        if result is not None:
+            area, cog, com, bbox = result
+        else:
+            full_scans += 1
+            thresh = find_bright_mask(frame, threshold)
+            area, cog, com = measure_mask(thresh, method)
+            bbox = cv2.boundingRect(thresh)
+        if track:
+            # Search next around where the ribbon will be if it keeps moving the same way
+            roi = None
+            if area:
+                dx, dy = (bbox[0] - last_bbox[0], bbox[1] - last_bbox[1]) if last_bbox else (0, 0)
+                roi = expand_roi((bbox[0] + dx, bbox[1] + dy) + tuple(bbox[2:]), margin, frame.shape)
+            last_bbox = bbox if area else None
 
-        # Save the marked frame at specific intervals
-        if frame_idx % int(fps) == 0:  # Save one frame per second
+        # Save the marked frame at specific intervals, marking only the frames that are saved
+        if save_frame:
+            marked_frame = mark_bright_ribbon(frame, thresh)
             cv2.imwrite(os.path.join(output_folder, f"frame_{frame_idx}.png"), marked_frame)
         
-        # Append area and corresponding time
-        areas.append(area)
-        times.append(frame_idx * dt)
+        # Store the time, area and positions
+        if frame_idx == len(rows):
+            rows = np.concatenate([rows, np.zeros_like(rows)])
+        rows[frame_idx] = (frame_idx * dt, area) + cog + com
         
         frame_idx += 1
 
     cap.release()
-    return areas, times, fps
+    if track:
+        print(f"Scanned {full_scans} of {frame_idx} frames in full; tracked the rest.")
+    metrics = {name: rows[:frame_idx, i].copy() for i, name in enumerate(METRIC_COLUMNS)}
+    return metrics, fps
 
 # Function to calculate the velocity from the area changes
 def calculate_velocity(areas, times):
-    velocities = []
-    for i in range(1, len(areas)):
-        dA = areas[i] - areas[i - 1]
-        dt = times[i] - times[i - 1]
-        velocity = dA / dt if dt != 0 else 0  # Avoid division by zero
-        velocities.append(velocity)
-    return velocities
+    dA = np.diff(np.asarray(areas, dtype=float))
+    dt = np.diff(np.asarray(times, dtype=float))
+    return np.divide(dA, dt, out=np.zeros_like(dA), where=dt != 0)  # Avoid division by zero
+
+# Function to smooth a series with a centered moving average
+def smooth_series(values, window):
+    """
+    Centered moving average over window samples; near the ends the average covers the
+    samples that exist. window <= 1 returns the values unchanged.
+    """
+    values = np.asarray(values, dtype=float)
+    if window <= 1 or len(values) == 0:
+        return values
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    index = np.arange(len(values))
+    start = np.maximum(index - window // 2, 0)
+    stop = np.minimum(index + (window - 1) // 2 + 1, len(values))
+    return (cumulative[stop] - cumulative[start]) / (stop - start)
+
+# Function to add the velocity and acceleration of the area to the metrics
+def add_derivatives(metrics, smooth_window=1):
+    """
+    Add "velocity" and "acceleration" columns: the change in area per second between each
+    frame and the one before it, and the change in that velocity. The first one or two rows
+    have no previous frame and are NaN. smooth_window > 1 smooths the area with a moving
+    average first (see smooth_series), which keeps the differences from amplifying noise.
+
+    Returns:
+    - metrics (dict): The same dict, with the new columns.
+    """
+    area = smooth_series(metrics["area"], smooth_window)
+    velocity = np.full(len(area), np.nan)
+    acceleration = np.full(len(area), np.nan)
+    if len(area) > 1:
+        velocity[1:] = calculate_velocity(area, metrics["time"])
+        acceleration[2:] = calculate_velocity(velocity[1:], metrics["time"][1:])
+    metrics["velocity"] = velocity
+    metrics["acceleration"] = acceleration
+    return metrics
+
+# Function to save the metrics as columns (.npz, or .parquet with pandas)
+def save_metrics(metrics, path):
+    if path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("Saving metrics as Parquet needs pandas (and pyarrow); use a .npz path instead.")
+        pd.DataFrame(metrics).to_parquet(path, index=False)
+    else:
+        np.savez(path, **metrics)
+    print(f"Saved the metrics of {len(metrics['time'])} frames to '{path}'")
+
+# Function to load metrics saved by save_metrics
+def load_metrics(path):
+    if path.endswith(".parquet"):
+        import pandas as pd
+        frame = pd.read_parquet(path)
+        return {name: frame[name].to_numpy() for name in frame.columns}
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
 
 # Function to plot the results (area and velocity)
 def plot_results(areas, velocities, times):
@@ -104,18 +350,187 @@ def plot_results(areas, velocities, times):
     plt.tight_layout()
     plt.show()
 
+# Function to describe the video and options that a set of metrics was made from
+def metrics_signature(video_path, options):
+    """
+    The absolute path, size and modification time of the video and the analysis options,
+    as stored next to saved metrics. Saved metrics are only reused while this matches.
+    """
+    info = os.stat(video_path)
+    # Round-trip the options through JSON so they compare equal to the stored ones
+    return {"path": os.path.abspath(video_path), "size": info.st_size, "mtime": info.st_mtime,
+            "options": json.loads(json.dumps(options))}
+
 # Main function to execute everything
-def main(video_path, output_folder):
-    # Process the video to get areas and times
-    areas, times, fps = process_video(video_path, output_folder)
+def main(video_path, output_folder, metrics_path=None, smooth_window=1, **process_options):
+    # Reload the metrics if they were saved for this video with the same options
+    signature_path = f"{metrics_path}.json"
+    signature = metrics_signature(video_path, dict(process_options, smooth_window=smooth_window))
+    saved_signature = None
+    if metrics_path and os.path.exists(metrics_path) and os.path.exists(signature_path):
+        with open(signature_path) as f:
+            saved_signature = json.load(f)
 
-    # Calculate velocity from the change in area
-    velocities = calculate_velocity(areas, times)
+    if saved_signature == signature:
+        metrics = load_metrics(metrics_path)
+        print(f"Loaded the metrics from '{metrics_path}'")
+    else:
+        if metrics_path and os.path.exists(metrics_path):
+            print(f"'{metrics_path}' was made from another video or with other options. Processing again.")
+        metrics, fps = process_video(video_path, output_folder, **process_options)
+
+        # Calculate velocity and acceleration from the change in area
+        add_derivatives(metrics, smooth_window)
+        if metrics_path:
+            save_metrics(metrics, metrics_path)
+            with open(signature_path, "w") as f:
+                json.dump(signature, f, indent=2)
 
     # Plot the area and velocity over time
-    plot_results(areas, velocities, times)
+    plot_results(metrics["area"], metrics["velocity"][1:], metrics["time"])
+
+# Function to save the area, COG and COM graphs of a video without showing them
+def save_metric_graphs(metrics, output_path):
+    # A Figure without pyplot needs no display, so this also works in worker processes
+    fig = Figure(figsize=(12, 8))
+    times = metrics["time"]
+
+    # Plot 1: Change in area over time
+    ax = fig.add_subplot(3, 1, 1)
+    ax.plot(times, metrics["area"], color='blue', label="Bright Ribbon Area")
+    ax.set_xlabel('Time (seconds)')
+    ax.set_ylabel('Area (pixels)')
+    ax.set_title('Change in Area of Bright Ribbon Over Time')
+    ax.legend()
+    ax.grid(True)
+
+    # Plot 2: Change in Center of Gravity (COG) over time
+    ax = fig.add_subplot(3, 1, 2)
+    ax.plot(times, metrics["cog_x"], label="COG X", color='green')
+    ax.plot(times, metrics["cog_y"], label="COG Y", color='orange')
+    ax.set_xlabel('Time (seconds)')
+    ax.set_ylabel('COG Position (pixels)')
+    ax.set_title('Change in Center of Gravity Over Time')
+    ax.legend()
+    ax.grid(True)
+
+    # Plot 3: Change in Center of Mass (COM) over time
+    ax = fig.add_subplot(3, 1, 3)
+    ax.plot(times, metrics["com_x"], label="COM X", color='red')
+    ax.plot(times, metrics["com_y"], label="COM Y", color='purple')
+    ax.set_xlabel('Time (seconds)')
+    ax.set_ylabel('COM Position (pixels)')
+    ax.set_title('Change in Center of Mass Over Time')
+    ax.legend()
+    ax.grid(True)
+
+    fig.tight_layout()
+    fig.savefig(output_path)
+
+# Function to analyze one video of a batch, run in a worker process
+def _analyze_video(video_path, output_root, options, name):
+    process_options = {key: value for key, value in options.items() if key != "smooth_window"}
+    metrics, fps = process_video(video_path, os.path.join(output_root, "frames", name), **process_options)
+    if len(metrics["time"]) == 0:
+        raise IOError(f"No frames could be read from '{video_path}'")
+    add_derivatives(metrics, options.get("smooth_window", 1))
+
+    metrics_path = os.path.join(output_root, "metrics", f"{name}.npz")
+    graph_path = os.path.join(output_root, "graphs", f"g_{name}.png")
+    save_metrics(metrics, metrics_path)
+    save_metric_graphs(metrics, graph_path)
+    return {"metrics": metrics_path, "graph": graph_path, "frames": len(metrics["time"]), "fps": fps}
+
+# Function to analyze many videos in parallel, skipping the ones already analyzed
+def analyze_videos(videos, output_root=".", workers=None, **options):
+    """
+    Analyze a batch of videos on a process pool, one video per worker.
+
+    For every video <name> this writes marked frames to <output_root>/frames/<name>/, the
+    metrics columns (with velocity and acceleration) to <output_root>/metrics/<name>.npz
+    and the area, COG and COM graphs to <output_root>/graphs/g_<name>.png, without opening
+    any windows. <name> is the file name without extension, followed by a short hash of
+    the video's path when another video (in this batch or the manifest) has the same
+    name. <output_root>/manifest.json records every finished video with its size,
+    modification time and options (see metrics_signature), and videos whose entry still
+    matches are skipped.
+
+    Parameters:
+    - videos (str or list): Video paths and/or glob patterns, e.g. 'picvid/*.mp4'.
+    - output_root (str): Folder for the frames, metrics, graphs and manifest.
+    - workers (int): Number of worker processes (default: number of CPUs).
+    - options: smooth_window (see add_derivatives) and the options of process_video
+      (method, threshold, track, margin, full_scan_every).
+
+    Returns:
+    - manifest (dict): The manifest entries of the videos, by path.
+    """
+    # Expand the globs
+    if isinstance(videos, str):
+        videos = [videos]
+    video_paths = []
+    for pattern in videos:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        video_paths.extend(os.path.abspath(path) for path in matches if os.path.abspath(path) not in video_paths)
+
+    for folder in ("frames", "metrics", "graphs"):
+        os.makedirs(os.path.join(output_root, folder), exist_ok=True)
+    manifest_path = os.path.join(output_root, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def write_manifest():
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    # Name the outputs after the videos, adding a hash of the path where names would collide
+    # (a/pendulum.mp4 and b/pendulum.mp4, or pendulum.mp4 and pendulum.avi)
+    taken = {os.path.splitext(os.path.basename(entry["metrics"]))[0]: path for path, entry in manifest.items()}
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in video_paths]
+    names = {}
+    for video_path, stem in zip(video_paths, stems):
+        if stems.count(stem) > 1 or taken.get(stem, video_path) != video_path:
+            stem = f"{stem}_{hashlib.sha1(video_path.encode()).hexdigest()[:8]}"
+        names[video_path] = stem
+
+    # Skip the videos analyzed before with the same options
+    pending = {}
+    for video_path in video_paths:
+        if not os.path.exists(video_path):
+            print(f"Error: Video '{video_path}' not found.")
+            continue
+        key = metrics_signature(video_path, options)
+        entry = manifest.get(video_path)
+        if entry and {k: entry.get(k) for k in key} == key and os.path.exists(entry["metrics"]):
+            print(f"Skipping '{video_path}', already analyzed.")
+            continue
+        pending[video_path] = key
+    print(f"Analyzing {len(pending)} of {len(video_paths)} videos.")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_analyze_video, video_path, output_root, options, names[video_path]): video_path
+                   for video_path in pending}
+        for future in as_completed(futures):
+            video_path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error: Failed to analyze '{video_path}': {e}")
+                continue
+            manifest[video_path] = dict(pending[video_path], **result)
+            write_manifest()  # Keep finished videos even if a later one fails
+            print(f"Analyzed '{video_path}' ({result['frames']} frames).")
+
+    return {video_path: manifest[video_path] for video_path in video_paths if video_path in manifest}
 
 # Example usage
-video_path = 'picvid/pendulum1.mp4'  # Path to your video file
-output_folder = 'saved_frames/'  # Folder to save marked frames
-main(video_path, output_folder)
+if __name__ == "__main__":
+    video_path = 'picvid/pendulum1.mp4'  # Path to your video file
+    output_folder = 'saved_frames/'  # Folder to save marked frames
+    main(video_path, output_folder)
+
+    # Or analyze all recordings headlessly, e.g.:
+    # analyze_videos('picvid/*.mp4', output_root='.', threshold=50, track=True)